@@ -22,25 +22,61 @@ sys.path.append('./models/pyAudioAnalysis')
 
 # ---------------- 配置 ----------------
 ASR_MODEL_PATH = "./models/SenseVoiceSmall"   # SenseVoice 模型路径
+VAD_MODEL_PATH = "./models/vad_model.pkl"      # 预训练VAD模型路径（不存在时用首段录音在内存中训练）
 SAMPLE_RATE = 16000
 RECORD_SECONDS = 5
+VAD_BLOCK_SECONDS = 0.02   # 流式VAD每次读取的音频块时长
+END_PAUSE_SECONDS = 0.6    # 说话结束后停顿多久停止录音
 
 # 对话历史管理
 conversation_history = []
+# 用首段录音训练的VAD模型（仅保存在内存中，见 get_vad_model）
+session_vad_model = None
 # --------------------------------------
 
 def record_audio(filename="input.wav"):
+    """录音，并用流式VAD检测说话结束后提前停止。返回语音段落(秒)或None"""
     print("🎙️ 录音中...")
     print("💡 请清晰地说出你的话，保持适中的音量...")
     
-    # 增加录音时长，给用户更多时间
+    # 最长录音时长（未检测到说话结束时的上限）
     record_duration = RECORD_SECONDS + 1  # 6秒
     
-    audio = sd.rec(int(record_duration * SAMPLE_RATE), samplerate=SAMPLE_RATE, channels=1, dtype="int16")
-    sd.wait()
+    try:
+        from pyAudioAnalysis.audioSegmentation import StreamingVAD
+        vad = StreamingVAD(SAMPLE_RATE)
+    except Exception as e:
+        print(f"⚠️ 流式VAD加载失败: {e}，使用固定时长录音")
+        vad = None
+    
+    block = int(VAD_BLOCK_SECONDS * SAMPLE_RATE)
+    max_blocks = int(record_duration * SAMPLE_RATE / block)
+    chunks = []
+    speech_end = None
+    with sd.InputStream(samplerate=SAMPLE_RATE, channels=1, dtype="int16",
+                        blocksize=block) as stream:
+        for _ in range(max_blocks):
+            data, _ = stream.read(block)
+            chunks.append(data.copy())
+            if vad is None:
+                continue
+            for event, t in vad.push(data[:, 0]):
+                speech_end = t if event == "end" else None
+            # 说话结束后停顿足够长（期间没有新的语音）即停止录音
+            recorded = len(chunks) * VAD_BLOCK_SECONDS
+            if speech_end is not None and recorded - speech_end >= END_PAUSE_SECONDS:
+                break
+    audio = np.concatenate(chunks) if chunks else np.zeros((0, 1), dtype=np.int16)
+    
+    segment = None
+    if vad is not None:
+        vad.flush()
+        if vad.segments:
+            # 语音段落：第一个起点到最后一个终点
+            segment = (vad.segments[0][0], vad.segments[-1][1])
     
     # 检查录音音量
-    max_volume = np.max(np.abs(audio))
+    max_volume = np.max(np.abs(audio)) if audio.size > 0 else 0
     if max_volume < 1000:  # 音量太低
         print("⚠️ 录音音量较低，可能影响识别效果")
     elif max_volume > 30000:  # 音量太高
@@ -54,9 +90,25 @@ def record_audio(filename="input.wav"):
     wf.setframerate(SAMPLE_RATE)
     wf.writeframes(audio.tobytes())
     wf.close()
-    print("✅ 录音完成:", filename)
+    print(f"✅ 录音完成: {filename} ({len(audio) / SAMPLE_RATE:.2f}s)")
+    return segment
 
-def vad_trim(input_file="input.wav"):
+def get_vad_model(x, fs):
+    """加载预训练VAD模型；模型文件不存在时用当前录音训练，本次运行内复用"""
+    global session_vad_model
+    from pyAudioAnalysis.audioSegmentation import load_vad_model, train_vad_model
+    if os.path.exists(VAD_MODEL_PATH):
+        return load_vad_model(VAD_MODEL_PATH)
+    if session_vad_model is None:
+        print("🔧 用当前录音训练VAD模型（不保存到磁盘）")
+        # VAD只需要时域和频谱特征，跳过MFCC/色度特征的计算
+        # 不写入 VAD_MODEL_PATH：首段录音可能是静音、削波或噪声，不能让它影响以后的会话
+        session_vad_model = train_vad_model(x, fs, 0.020, 0.020,
+                                            features=["time", "spectral"])
+    return session_vad_model
+
+def vad_trim(input_file="input.wav", segment=None):
+    """截取语音段落。segment为录音时流式VAD检测到的段落(秒)，为None时离线检测"""
     print("🔍 VAD 检测语音段落...")
     try:
         # 检查音频文件是否存在
@@ -66,12 +118,18 @@ def vad_trim(input_file="input.wav"):
         
         # 尝试使用pyAudioAnalysis进行VAD
         try:
-            from pyAudioAnalysis.audioSegmentation import silence_removal
-            from pyAudioAnalysis.audioBasicIO import read_audio_file
-            
-            # 正确的方式：先读取音频数据，再传递给silence_removal
-            [Fs, x] = read_audio_file(input_file)
-            segments = silence_removal(x, Fs, 0.020, 0.020, smooth_window=1.0, weight=0.3)
+            if segment is not None:
+                # 录音时已由流式VAD检测，无需重新训练SVM
+                segments = [segment]
+            else:
+                from pyAudioAnalysis.audioSegmentation import silence_removal
+                from pyAudioAnalysis.audioBasicIO import read_audio_file
+                
+                # 正确的方式：先读取音频数据，再传递给silence_removal
+                [Fs, x] = read_audio_file(input_file)
+                # 使用预训练的VAD模型（每个进程只加载/训练一次），不再对每段录音重新训练SVM
+                segments = silence_removal(x, Fs, 0.020, 0.020, smooth_window=1.0, weight=0.3,
+                                           model=get_vad_model(x, Fs))
             
             if len(segments) == 0:
                 print("🔍 未检测到语音段落，使用原始音频")
@@ -424,8 +482,8 @@ def interactive_mode():
                 break
             elif command in ['r', 'record']:
                 print("\n🎙️ 开始录音对话...")
-                record_audio()
-                speech_file = vad_trim()
+                segment = record_audio()
+                speech_file = vad_trim(segment=segment)
                 user_text = asr_transcribe(speech_file)
                 
                 # 音频基础分析
@@ -458,8 +516,8 @@ if __name__ == "__main__":
     else:
         # 默认单次运行模式
         print("🎙️ 单次录音模式 (使用 -i 参数进入交互模式)")
-        record_audio()
-        speech_file = vad_trim()
+        segment = record_audio()
+        speech_file = vad_trim(segment=segment)
         user_text = asr_transcribe(speech_file)
         # 音频基础分析
         _ = analyze_audio_basic(speech_file)
@@ -2,15 +2,21 @@ from __future__ import print_function
 import os
 import time
 import glob
+import json
+import hashlib
+import concurrent.futures
 import numpy as np
 import matplotlib.pyplot as plt
 import sys
 sys.path.insert(0, os.path.join(
     os.path.dirname(os.path.realpath(__file__)), "../"))
+from pyAudioAnalysis import __version__
 from pyAudioAnalysis import utilities
 from pyAudioAnalysis import audioBasicIO
 from pyAudioAnalysis import ShortTermFeatures
 eps = 0.00000001
+# number of audio files that are packed in each batched feature extraction
+FILE_BATCH_SIZE = 32
 
 """ Time-domain audio features """
 
@@ -31,36 +37,38 @@ def beat_extraction(short_features, window_size, plot=False):
                          11, 12, 13, 14, 15, 16, 17, 18]
 
     max_beat_time = int(round(2.0 / window_size))
-    hist_all = np.zeros((max_beat_time,))
-    # for each feature
-    for ii, i in enumerate(selected_features):
-        # dif threshold (3 x Mean of Difs)
-        dif_threshold = 2.0 * (np.abs(short_features[i, 0:-1] -
-                                      short_features[i, 1::])).mean()
-        if dif_threshold <= 0:
-            dif_threshold = 0.0000000000000001
-        # detect local maxima
-        [pos1, _] = utilities.peakdet(short_features[i, :], dif_threshold)
-        position_diffs = []
-        # compute histograms of local maxima changes
-        for j in range(len(pos1)-1):
-            position_diffs.append(pos1[j+1]-pos1[j])
-        histogram_times, histogram_edges = \
-            np.histogram(position_diffs, np.arange(0.5, max_beat_time + 1.5))
-        hist_centers = (histogram_edges[0:-1] + histogram_edges[1::]) / 2.0
-        histogram_times = \
-            histogram_times.astype(float) / short_features.shape[1]
-        hist_all += histogram_times
-        if plot:
+    features = short_features[selected_features, :]
+    # dif threshold (3 x Mean of Difs)
+    dif_thresholds = 2.0 * np.abs(features[:, 0:-1] -
+                                  features[:, 1::]).mean(axis=1)
+    dif_thresholds[dif_thresholds <= 0] = 0.0000000000000001
+    # detect local maxima (of all features in one batch)
+    positions, _ = utilities.peakdet_rows(features, dif_thresholds)
+
+    # compute histograms of local maxima changes (one row per feature)
+    n_selected = len(selected_features)
+    position_diffs = [np.diff(pos1) for pos1 in positions]
+    rows = np.repeat(np.arange(n_selected), [len(d) for d in position_diffs])
+    position_diffs = np.concatenate(position_diffs)
+    valid = (position_diffs >= 1) & (position_diffs <= max_beat_time)
+    histograms = np.bincount(rows[valid] * max_beat_time +
+                             position_diffs[valid] - 1,
+                             minlength=n_selected * max_beat_time)
+    histograms = histograms.reshape(n_selected, max_beat_time)
+    histogram_edges = np.arange(0.5, max_beat_time + 1.5)
+    hist_centers = (histogram_edges[0:-1] + histogram_edges[1::]) / 2.0
+    hist_all = np.sum(histograms.astype(float) / short_features.shape[1],
+                      axis=0)
+
+    if plot:
+        for ii, i in enumerate(selected_features):
             plt.subplot(9, 2, ii + 1)
             plt.plot(short_features[i, :], 'k')
-            for k in pos1:
+            for k in positions[ii]:
                 plt.plot(k, short_features[i, k], 'k*')
             f1 = plt.gca()
             f1.axes.get_xaxis().set_ticks([])
             f1.axes.get_yaxis().set_ticks([])
-
-    if plot:
         plt.show(block=False)
         plt.figure()
 
@@ -84,46 +92,382 @@ def beat_extraction(short_features, window_size, plot=False):
     return bpm, ratio
 
 
+""" Mid-term feature cache """
+
+
+class MidTermFeatureCache:
+    """
+    Content-addressed on-disk cache of mid_feature_extraction() results.
+    Each entry is keyed by a hash of the audio samples, the window / step
+    parameters, the feature dtype and the library version, and it is stored
+    as .npy files in cache_dir. When the total size of the cache exceeds
+    max_size (bytes), the least recently used entries are evicted.
+    Enable it for all mid-term feature extraction calls with
+    set_feature_cache().
+    ARGUMENTS:
+        - cache_dir:    the cache directory (created if needed)
+        - max_size:     maximum total size of the cached files (in bytes)
+        - mmap_mode:    (opt) if set (e.g. "r"), cached features are
+                        returned as memory-mapped arrays (see np.load)
+    """
+
+    suffixes = ("_mt.npy", "_st.npy", "_names.npy")
+
+    def __init__(self, cache_dir, max_size=2 ** 30, mmap_mode=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.mmap_mode = mmap_mode
+        # total size of the cached files (computed at the first store)
+        self.size = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, signal, sampling_rate, mid_window, mid_step, short_window,
+            short_step, dtype=np.float64):
+        """
+        Returns the cache key of a mid-term feature extraction call
+        """
+        signal = np.ascontiguousarray(signal)
+        parameters = (__version__, float(sampling_rate), float(mid_window),
+                      float(mid_step), float(short_window),
+                      float(short_step), np.dtype(dtype).str,
+                      signal.dtype.str, signal.shape)
+        content_hash = hashlib.sha1(repr(parameters).encode())
+        content_hash.update(signal.data)
+        return content_hash.hexdigest()
+
+    def paths(self, key):
+        return [os.path.join(self.cache_dir, key + suffix)
+                for suffix in self.suffixes]
+
+    def load(self, key):
+        """
+        Returns the cached (mid_features, short_features, mid_feature_names)
+        of a key, or None if the key is not cached
+        """
+        paths = self.paths(key)
+        try:
+            mid_features = np.load(paths[0], mmap_mode=self.mmap_mode)
+            short_features = np.load(paths[1], mmap_mode=self.mmap_mode)
+            mid_feature_names = np.load(paths[2]).tolist()
+            # mark the entry as recently used
+            for path in paths:
+                os.utime(path)
+        except (IOError, ValueError):
+            return None
+        return mid_features, short_features, mid_feature_names
+
+    def store(self, key, mid_features, short_features, mid_feature_names):
+        """
+        Stores the features of a key and evicts the least recently used
+        entries if the cache has grown beyond max_size
+        """
+        arrays = (mid_features, short_features, np.array(mid_feature_names))
+        for path, array in zip(self.paths(key), arrays):
+            # write to a temporary file first, so that concurrent readers
+            # never see partially written entries
+            temp_path = "{0:s}.{1:d}.tmp".format(path, os.getpid())
+            with open(temp_path, "wb") as fp:
+                np.save(fp, array)
+            os.replace(temp_path, path)
+            if self.size is not None:
+                self.size += os.path.getsize(path)
+        if self.size is None or self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """
+        Evicts the least recently used entries until the total size of the
+        cache is at most max_size
+        """
+        entries = {}
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(self.suffixes):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            key = name.rsplit("_", 1)[0]
+            last_used, size = entries.get(key, (0, 0))
+            entries[key] = (max(last_used, stat.st_mtime), size + stat.st_size)
+
+        self.size = sum(size for _, size in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k][0]):
+            if self.size <= self.max_size:
+                break
+            for path in self.paths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self.size -= entries[key][1]
+
+
+# the cache of mid_feature_extraction() (disabled by default)
+feature_cache = None
+
+
+def set_feature_cache(cache_dir, max_size=2 ** 30, mmap_mode=None):
+    """
+    Enables the on-disk mid-term feature cache (see MidTermFeatureCache) for
+    all subsequent mid_feature_extraction() calls (i.e. also for
+    file_classification(), mid_term_file_classification(), hmm_segmentation()
+    and speaker_diarization()). Use cache_dir=None to disable it.
+    """
+    global feature_cache
+    if cache_dir is None:
+        feature_cache = None
+    else:
+        feature_cache = MidTermFeatureCache(cache_dir, max_size, mmap_mode)
+    return feature_cache
+
+
 def mid_feature_extraction(signal, sampling_rate, mid_window, mid_step,
-                           short_window, short_step):
+                           short_window, short_step, dtype=np.float64):
     """
     Mid-term feature extraction
+    (dtype=np.float32 keeps both the short-term and the mid-term features in
+    single precision, see ShortTermFeatures.feature_extraction)
+    If a feature cache is enabled (see set_feature_cache), the features are
+    loaded from the cache when the same signal has already been analyzed
+    with the same parameters.
     """
 
+    if feature_cache is not None:
+        key = feature_cache.key(signal, sampling_rate, mid_window, mid_step,
+                                short_window, short_step, dtype)
+        cached = feature_cache.load(key)
+        if cached is not None:
+            return cached
+
     short_features, short_feature_names = \
         ShortTermFeatures.feature_extraction(signal, sampling_rate,
-                                             short_window, short_step)
+                                             short_window, short_step,
+                                             dtype=dtype)
+
+    mid_features, mid_feature_names = \
+        mid_term_statistics(short_features, short_feature_names,
+                            mid_window, mid_step, short_window, short_step,
+                            dtype)
+    if feature_cache is not None:
+        feature_cache.store(key, mid_features, short_features,
+                            mid_feature_names)
+    return mid_features, short_features, mid_feature_names
+
+
+def mid_term_statistics(short_features, short_feature_names, mid_window,
+                        mid_step, short_window, short_step,
+                        dtype=np.float64):
+    """
+    Computes the mid-term statistics (mean and std) of a short-term feature
+    matrix (windows and steps in samples, see mid_feature_extraction)
+    """
 
     n_stats = 2
-    n_feats = len(short_features)
+    n_feats, num_short_features = short_features.shape
     #mid_window_ratio = int(round(mid_window / short_step))
     mid_window_ratio = round((mid_window -
                               (short_window - short_step)) / short_step)
     mt_step_ratio = int(round(mid_step / short_step))
 
-    mid_features, mid_feature_names = [], []
-    for i in range(n_stats * n_feats):
-        mid_features.append([])
-        mid_feature_names.append("")
-
-    # for each of the short-term features:
-    for i in range(n_feats):
-        cur_position = 0
-        num_short_features = len(short_features[i])
-        mid_feature_names[i] = short_feature_names[i] + "_" + "mean"
-        mid_feature_names[i + n_feats] = short_feature_names[i] + "_" + "std"
-
-        while cur_position < num_short_features:
-            end = cur_position + mid_window_ratio
-            if end > num_short_features:
-                end = num_short_features
-            cur_st_feats = short_features[i][cur_position:end]
-
-            mid_features[i].append(np.mean(cur_st_feats))
-            mid_features[i + n_feats].append(np.std(cur_st_feats))
-            cur_position += mt_step_ratio
-    mid_features = np.array(mid_features)
-    mid_features = np.nan_to_num(mid_features)
+    mid_feature_names = [name + "_" + "mean" for name in short_feature_names] \
+        + [name + "_" + "std" for name in short_feature_names]
+
+    # a mid-term window starts every mt_step_ratio short-term windows (the
+    # last ones are truncated at the end of the short-term feature sequence)
+    starts = np.arange(0, num_short_features, mt_step_ratio)
+    n_windows = len(starts)
+    mid_features = np.zeros((n_stats * n_feats, n_windows), dtype=dtype)
+    n_full = 0
+    if mid_window_ratio > 0:
+        n_full = np.count_nonzero(starts + mid_window_ratio <=
+                                  num_short_features)
+
+    # full mid-term windows: one pass over a (strided) sliding window view
+    if n_full > 0:
+        windows = np.lib.stride_tricks.sliding_window_view(
+            short_features, mid_window_ratio, axis=1)
+        windows = windows[:, 0:(n_full - 1) * mt_step_ratio + 1:mt_step_ratio]
+        mid_features[:n_feats, :n_full] = np.mean(windows, axis=2)
+        mid_features[n_feats:, :n_full] = np.std(windows, axis=2)
+
+    # truncated mid-term windows at the end of the sequence
+    for j in range(n_full, n_windows):
+        cur_st_feats = short_features[:, starts[j]:
+                                      starts[j] + mid_window_ratio]
+        if cur_st_feats.shape[1] > 0:
+            mid_features[:n_feats, j] = np.mean(cur_st_feats, axis=1)
+            mid_features[n_feats:, j] = np.std(cur_st_feats, axis=1)
+    mid_features = np.nan_to_num(mid_features, copy=False)
+    return mid_features, mid_feature_names
+
+
+class MidTermFeatureStream:
+    """
+    Incremental (streaming) mid-term feature extractor.
+    Raw int16 chunks are pushed to a ShortTermFeatureStream and the mid-term
+    statistics (mean and std) of all mid-term windows that became complete
+    are returned, with the same windowing as mid_feature_extraction()
+    (windows and steps in samples). Only the short-term features of the
+    mid-term windows that are still open are kept, so memory does not grow
+    with the length of the stream. flush() returns the truncated windows at
+    the end of the stream, like mid_term_statistics().
+
+    The short-term features of a live stream are normalized with running
+    DC / peak estimates (see ShortTermFeatures.ShortTermFeatureStream), so
+    they only converge to those of mid_feature_extraction() once these
+    estimates have settled. For a signal that is known in advance, pass its
+    ShortTermFeatures.normalization_constants() as normalization to get the
+    features of mid_feature_extraction() for any chunking.
+
+    USAGE EXAMPLE:
+        stream = MidTermFeatureStream(16000, 16000, 8000, 800, 800)
+        for chunk in chunks:
+            new_features = stream.push(chunk)   # (n_feats x n_new_windows)
+        new_features = stream.flush()
+    """
+
+    def __init__(self, sampling_rate, mid_window, mid_step, short_window,
+                 short_step, dtype=np.float64, normalization=None):
+        self.dtype = dtype
+        self.mid_window = mid_window
+        self.mid_step = mid_step
+        self.short_window = short_window
+        self.short_step = short_step
+        self.short_stream = ShortTermFeatures.ShortTermFeatureStream(
+            sampling_rate, short_window, short_step, dtype=dtype,
+            normalization=normalization)
+        self.short_feature_names = self.short_stream.feature_names
+        self.feature_names = \
+            [name + "_" + "mean" for name in self.short_feature_names] + \
+            [name + "_" + "std" for name in self.short_feature_names]
+        self.mid_window_ratio = max(round((mid_window -
+                                           (short_window - short_step)) /
+                                          short_step), 1)
+        self.mt_step_ratio = max(int(round(mid_step / short_step)), 1)
+        self.reset()
+
+    def reset(self):
+        """Clears all carried state (e.g. at the start of a new recording)"""
+        self.short_stream.reset()
+        self.short_features = np.zeros((len(self.short_feature_names), 0),
+                                       dtype=self.dtype)
+        self.n_skip = 0
+        self.n_windows = 0
+
+    def push(self, chunk):
+        """
+        Appends a chunk of samples to the stream.
+        RETURNS
+            features:   (n_feats x n_new_windows) mid-term features of the
+                        mid-term windows that were completed by this chunk
+                        (possibly zero columns)
+        """
+        new_short_features = self.short_stream.push(chunk)
+        n_skipped = min(self.n_skip, new_short_features.shape[1])
+        self.n_skip -= n_skipped
+        self.short_features = np.concatenate(
+            (self.short_features, new_short_features[:, n_skipped:]), axis=1)
+        n_short = self.short_features.shape[1]
+        n_feats = len(self.short_feature_names)
+        n_new = 0
+        if n_short >= self.mid_window_ratio:
+            n_new = (n_short - self.mid_window_ratio) // \
+                self.mt_step_ratio + 1
+        features = np.zeros((2 * n_feats, n_new), dtype=self.dtype)
+        if n_new == 0:
+            return features
+
+        windows = np.lib.stride_tricks.sliding_window_view(
+            self.short_features, self.mid_window_ratio, axis=1)
+        windows = windows[:, 0:(n_new - 1) * self.mt_step_ratio + 1:
+                          self.mt_step_ratio]
+        features[:n_feats] = np.mean(windows, axis=2)
+        features[n_feats:] = np.std(windows, axis=2)
+        features = np.nan_to_num(features, copy=False)
+
+        # keep the short-term features of the next (open) mid-term windows
+        # (if the mid-term step is longer than the window, the short-term
+        # windows up to the next mid-term window start are skipped)
+        self.n_skip = max(n_new * self.mt_step_ratio - n_short, 0)
+        self.short_features = \
+            self.short_features[:, n_new * self.mt_step_ratio:].copy()
+        self.n_windows += n_new
+        return features
+
+    def flush(self):
+        """
+        Ends the stream.
+        RETURNS
+            features:   (n_feats x n_windows) mid-term features of the
+                        remaining (truncated) mid-term windows
+        """
+        features, _ = mid_term_statistics(self.short_features,
+                                          self.short_feature_names,
+                                          self.mid_window, self.mid_step,
+                                          self.short_window, self.short_step,
+                                          self.dtype)
+        self.n_windows += features.shape[1]
+        self.short_features = self.short_features[:, 0:0]
+        return features
+
+
+def batch_mid_feature_extraction(inputs, mid_window, mid_step,
+                                 short_window, short_step, dtype=np.float64):
+    """
+    Mid-term feature extraction for a list of audio files or signals.
+    The inputs are grouped by sampling rate and the short-term features of
+    each group are extracted with a single batched pass
+    (see ShortTermFeatures.feature_extraction_batch), which amortizes the
+    per-call overhead over many (short) audio clips.
+    ARGUMENTS:
+        - inputs:                     list of audio file paths and / or
+                                      (sampling_rate, signal) tuples
+                                      (None items are skipped)
+        - mid_window, mid_step:       mid-term window and step (in seconds)
+        - short_window, short_step:   short-term window and step (in seconds)
+    RETURNS:
+        - mid_features:      list of mid-term feature matrices (None for
+                             inputs that could not be read)
+        - short_features:    list of short-term feature matrices (None for
+                             inputs that could not be read)
+        - mid_feature_names: list of mid-term feature names
+    """
+
+    mid_features = [None] * len(inputs)
+    short_features = [None] * len(inputs)
+    mid_feature_names = []
+
+    # read the audio files and group the signals by sampling rate
+    groups = {}
+    for i, item in enumerate(inputs):
+        if item is None:
+            continue
+        if isinstance(item, str):
+            sampling_rate, signal = audioBasicIO.read_audio_file(item)
+        else:
+            sampling_rate, signal = item
+        if sampling_rate <= 0 or len(signal) == 0:
+            continue
+        signal = audioBasicIO.stereo_to_mono(signal)
+        groups.setdefault(sampling_rate, []).append((i, signal))
+
+    for sampling_rate, group in groups.items():
+        short_window_samples = round(sampling_rate * short_window)
+        short_step_samples = round(sampling_rate * short_step)
+        features, short_feature_names = \
+            ShortTermFeatures.feature_extraction_batch(
+                [signal for _, signal in group], sampling_rate,
+                short_window_samples, short_step_samples, dtype=dtype)
+        for (i, _), short_feats in zip(group, features):
+            short_features[i] = short_feats
+            mid_features[i], mid_feature_names = \
+                mid_term_statistics(short_feats, short_feature_names,
+                                    round(sampling_rate * mid_window),
+                                    round(sampling_rate * mid_step),
+                                    short_window_samples,
+                                    short_step_samples, dtype)
+
     return mid_features, short_features, mid_feature_names
 
 
@@ -137,25 +481,144 @@ def mid_feature_extraction(signal, sampling_rate, mid_window, mid_step,
  """
 
 
+def map_file_batches(function, file_list, n_jobs, *args):
+    """
+    Applies function(batch, *args) to consecutive batches of FILE_BATCH_SIZE
+    files of file_list and yields the results in the order of the batches.
+    If n_jobs (see utilities.effective_n_jobs) is more than one, the batches
+    are distributed to a pool of worker processes.
+    """
+    batches = [file_list[i:i + FILE_BATCH_SIZE]
+               for i in range(0, len(file_list), FILE_BATCH_SIZE)]
+    n_workers = min(utilities.effective_n_jobs(n_jobs), len(batches))
+    if n_workers <= 1:
+        for batch in batches:
+            yield function(batch, *args)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(n_workers) as executor:
+            futures = [executor.submit(function, batch, *args)
+                       for batch in batches]
+            for future in futures:
+                yield future.result()
+
+
+def read_batch_signals(file_list):
+    """
+    Reads the audio files of a batch (see map_file_batches).
+    RETURNS:
+        - signals:            (sampling_rate, signal) of each file (None for
+                              the files that were skipped)
+        - messages:           the skipping message of each file ("" if
+                              the file was read)
+    """
+    signals, messages = [], []
+    for file_path in file_list:
+        signals.append(None)
+        messages.append("")
+        if os.stat(file_path).st_size == 0:
+            messages[-1] = "   (EMPTY FILE -- SKIPPING)"
+            continue
+        try:
+            sampling_rate, signal = audioBasicIO.read_audio_file(file_path)
+        except (ValueError, EOFError, OSError):
+            messages[-1] = "   (UNREADABLE FILE -- SKIPPING)"
+            continue
+        if sampling_rate <= 0:
+            continue
+        signals[-1] = (sampling_rate, audioBasicIO.stereo_to_mono(signal))
+    return signals, messages
+
+
+def print_batch_messages(file_list, messages, first_index, n_files,
+                         skipped_only=False):
+    """
+    Prints the per-file log lines of a batch of files (first_index is the
+    index of the first file of the batch in a list of n_files files)
+    """
+    for i, (file_path, message) in enumerate(zip(file_list, messages)):
+        if skipped_only and not message:
+            continue
+        print("Analyzing file {0:d} of {1:d}: {2:s}".format(
+            first_index + i + 1, n_files, file_path))
+        if message:
+            print(message)
+
+
+def directory_batch_features(file_list, mid_window, mid_step,
+                             short_window, short_step, compute_beat):
+    """
+    Extracts the long-term averaged mid-term features of a batch of audio
+    files (the unit of work of directory_feature_extraction).
+    RETURNS:
+        - features:           (n_files x n_feats) matrix of the files whose
+                              features are valid
+        - feature_files:      the files of the rows of features
+        - valid_files:        files that were analyzed (long enough)
+        - messages:           the skipping message of each file ("" if
+                              the file was analyzed)
+        - mid_feature_names:  list of feature names
+        - duration:           total duration (in seconds) of the features
+    """
+
+    batch, valid_files = [], []
+    signals, messages = read_batch_signals(file_list)
+    for j, (file_path, item) in enumerate(zip(file_list, signals)):
+        if item is None:
+            continue
+        sampling_rate, signal = item
+        if signal.shape[0] < float(sampling_rate)/5:
+            messages[j] = "  (AUDIO FILE TOO SMALL - SKIPPING)"
+            continue
+        valid_files.append(file_path)
+        batch.append(item)
+
+    mid_features_list, short_features_list, mid_feature_names = \
+        batch_mid_feature_extraction(batch, mid_window, mid_step,
+                                     short_window, short_step)
+    if compute_beat:
+        mid_feature_names += ["bpm", "ratio"]
+    features, feature_files, duration = [], [], 0.0
+    for file_path, (sampling_rate, signal), mid_features, short_features in \
+            zip(valid_files, batch, mid_features_list, short_features_list):
+        # long term averaging of mid-term statistics
+        mid_features = mid_features.mean(axis=1)
+        if np.isnan(mid_features).any() or np.isinf(mid_features).any():
+            continue
+        if compute_beat:
+            beat, beat_conf = beat_extraction(short_features, short_step)
+            mid_features = np.append(mid_features, [beat, beat_conf])
+        features.append(mid_features)
+        feature_files.append(file_path)
+        duration += float(len(signal)) / sampling_rate
+
+    return np.array(features), feature_files, valid_files, messages, \
+        mid_feature_names, duration
+
+
 def directory_feature_extraction(folder_path, mid_window, mid_step,
                                  short_window, short_step,
-                                 compute_beat=True):
+                                 compute_beat=True, n_jobs=1):
     """
     This function extracts the mid-term features of the WAVE files of a 
     particular folder.
 
     The resulting feature vector is extracted by long-term averaging the
     mid-term features.
-    Therefore ONE FEATURE VECTOR is extracted for each WAV file.
+    Therefore ONE FEATURE VECTOR is extracted for each WAV file
+    (the files are processed in batches, see batch_mid_feature_extraction).
 
     ARGUMENTS:
         - folder_path:        the path of the WAVE directory
         - mid_window, mid_step:    mid-term window and step (in seconds)
         - short_window, short_step:    short-term window and step (in seconds)
+        - n_jobs:             number of worker processes (the batches of
+                              files are distributed to a process pool,
+                              see utilities.effective_n_jobs)
     """
 
     mid_term_features = np.array([])
-    process_times = []
+    n_valid = 0
+    total_duration = 0.0
 
     types = ('*.wav', '*.aif',  '*.aiff', '*.mp3', '*.au', '*.ogg')
     wav_file_list = []
@@ -164,66 +627,41 @@ def directory_feature_extraction(folder_path, mid_window, mid_step,
 
     wav_file_list = sorted(wav_file_list)    
     wav_file_list2, mid_feature_names = [], []
-    for i, file_path in enumerate(wav_file_list):
-        print("Analyzing file {0:d} of {1:d}: {2:s}".format(i + 1,
-                                                            len(wav_file_list),
-                                                            file_path))
-        if os.stat(file_path).st_size == 0:
-            print("   (EMPTY FILE -- SKIPPING)")
-            continue        
-        sampling_rate, signal = audioBasicIO.read_audio_file(file_path)
-        if sampling_rate == 0:
-            continue        
-
-        t1 = time.time()        
-        signal = audioBasicIO.stereo_to_mono(signal)
-        if signal.shape[0] < float(sampling_rate)/5:
-            print("  (AUDIO FILE TOO SMALL - SKIPPING)")
+    t1 = time.time()
+    i = 0
+    for features, _, valid_files, messages, batch_feature_names, duration \
+            in map_file_batches(directory_batch_features, wav_file_list,
+                                n_jobs, mid_window, mid_step, short_window,
+                                short_step, compute_beat):
+        print_batch_messages(wav_file_list[i:i + len(messages)], messages, i,
+                             len(wav_file_list))
+        i += len(messages)
+        wav_file_list2 += valid_files
+        if len(features) == 0:
             continue
-        wav_file_list2.append(file_path)
-        if compute_beat:
-            mid_features, short_features, mid_feature_names = \
-                mid_feature_extraction(signal, sampling_rate,
-                                       round(mid_window * sampling_rate),
-                                       round(mid_step * sampling_rate),
-                                       round(sampling_rate * short_window),
-                                       round(sampling_rate * short_step))
-            beat, beat_conf = beat_extraction(short_features, short_step)
-        else:
-            mid_features, _, mid_feature_names = \
-                mid_feature_extraction(signal, sampling_rate,
-                                       round(mid_window * sampling_rate),
-                                       round(mid_step * sampling_rate),
-                                       round(sampling_rate * short_window),
-                                       round(sampling_rate * short_step))
-
-        mid_features = np.transpose(mid_features)
-        mid_features = mid_features.mean(axis=0)
-        # long term averaging of mid-term statistics
-        if (not np.isnan(mid_features).any()) and \
-                (not np.isinf(mid_features).any()):
-            if compute_beat:
-                mid_features = np.append(mid_features, beat)
-                mid_features = np.append(mid_features, beat_conf)
-                mid_feature_names += ["bpm","ratio"]
-            if len(mid_term_features) == 0:
-                # append feature vector
-                mid_term_features = mid_features
-            else:
-                mid_term_features = np.vstack((mid_term_features, mid_features))
-            t2 = time.time()
-            duration = float(len(signal)) / sampling_rate
-            process_times.append((t2 - t1) / duration)
-    if len(process_times) > 0:
+        # (batches without valid files have no feature names)
+        if not mid_feature_names:
+            mid_feature_names = batch_feature_names
+        if len(mid_term_features) == 0:
+            # preallocate the feature matrix (one row per file)
+            mid_term_features = np.zeros((len(wav_file_list),
+                                          features.shape[1]))
+        mid_term_features[n_valid:n_valid + len(features)] = features
+        n_valid += len(features)
+        total_duration += duration
+    total_time = time.time() - t1
+
+    if n_valid > 0:
+        mid_term_features = mid_term_features[:n_valid]
         print("Feature extraction complexity ratio: "
-              "{0:.1f} x realtime".format((1.0 / 
-                                           np.mean(np.array(process_times)))))
+              "{0:.1f} x realtime".format(total_duration /
+                                          max(total_time, eps)))
     return mid_term_features, wav_file_list2, mid_feature_names
 
 
 def multiple_directory_feature_extraction(path_list, mid_window, mid_step,
                                           short_window, short_step,
-                                          compute_beat=False):
+                                          compute_beat=False, n_jobs=1):
     """
     Same as dirWavFeatureExtraction, but instead of a single dir it
     takes a list of paths as input and returns a list of feature matrices.
@@ -238,6 +676,7 @@ def multiple_directory_feature_extraction(path_list, mid_window, mid_step,
     It can be used during the training process of a classification model ,
     in order to get feature matrices from various audio classes (each stored in
     a separate path)
+    (n_jobs: number of worker processes, see directory_feature_extraction)
     """
 
     # feature extraction for each class:
@@ -248,7 +687,8 @@ def multiple_directory_feature_extraction(path_list, mid_window, mid_step,
         f, fn, feature_names = \
             directory_feature_extraction(d, mid_window, mid_step,
                                          short_window, short_step,
-                                         compute_beat=compute_beat)
+                                         compute_beat=compute_beat,
+                                         n_jobs=n_jobs)
         if f.shape[0] > 0:
             # if at least one audio file has been found in the provided folder:
             features.append(f)
@@ -260,8 +700,24 @@ def multiple_directory_feature_extraction(path_list, mid_window, mid_step,
     return features, class_names, file_names
 
 
+def directory_batch_features_no_avg(file_list, mid_window, mid_step,
+                                    short_window, short_step):
+    """
+    Extracts the (transposed) mid-term feature matrices of a batch of audio
+    files (the unit of work of directory_feature_extraction_no_avg), None
+    for the files that were skipped, the feature names and the skipping
+    messages (see read_batch_signals)
+    """
+    signals, messages = read_batch_signals(file_list)
+    mid_features, _, mid_feature_names = \
+        batch_mid_feature_extraction(signals, mid_window, mid_step,
+                                     short_window, short_step)
+    return [None if m is None else np.transpose(m) for m in mid_features], \
+        mid_feature_names, messages
+
+
 def directory_feature_extraction_no_avg(folder_path, mid_window, mid_step,
-                                        short_window, short_step):
+                                        short_window, short_step, n_jobs=1):
     """
     This function extracts the mid-term features of the WAVE
     files of a particular folder without averaging each file.
@@ -270,6 +726,8 @@ def directory_feature_extraction_no_avg(folder_path, mid_window, mid_step,
         - folder_path:          the path of the WAVE directory
         - mid_window, mid_step:    mid-term window and step (in seconds)
         - short_window, short_step:    short-term window and step (in seconds)
+        - n_jobs:               number of worker processes
+                                (see directory_feature_extraction)
     RETURNS:
         - X:                A feature matrix
         - Y:                A matrix of file labels
@@ -277,38 +735,274 @@ def directory_feature_extraction_no_avg(folder_path, mid_window, mid_step,
     """
 
     wav_file_list = []
-    signal_idx = np.array([])
-    mid_features = np.array([])
     types = ('*.wav', '*.aif',  '*.aiff', '*.ogg')
     for files in types:
         wav_file_list.extend(glob.glob(os.path.join(folder_path, files)))
 
     wav_file_list = sorted(wav_file_list)
 
-    for i, file_path in enumerate(wav_file_list):
-        sampling_rate, signal = audioBasicIO.read_audio_file(file_path)
-        if sampling_rate == 0:
-            continue
-        signal = audioBasicIO.stereo_to_mono(signal)
-        mid_feature_vector, _, _ = \
-            mid_feature_extraction(signal, sampling_rate,
-                                   round(mid_window * sampling_rate),
-                                   round(mid_step * sampling_rate),
-                                   round(sampling_rate * short_window),
-                                   round(sampling_rate * short_step))
-
-        mid_feature_vector = np.transpose(mid_feature_vector)
-        if len(mid_features) == 0:                # append feature vector
-            mid_features = mid_feature_vector
-            signal_idx = np.zeros((mid_feature_vector.shape[0], ))
-        else:
-            mid_features = np.vstack((mid_features, mid_feature_vector))
-            signal_idx = np.append(signal_idx, i *
-                                   np.ones((mid_feature_vector.shape[0], )))
+    file_features = []
+    for batch_features, _, messages in \
+            map_file_batches(directory_batch_features_no_avg, wav_file_list,
+                             n_jobs, mid_window, mid_step, short_window,
+                             short_step):
+        print_batch_messages(wav_file_list[len(file_features):
+                                           len(file_features) +
+                                           len(messages)],
+                             messages, len(file_features),
+                             len(wav_file_list), skipped_only=True)
+        file_features += batch_features
+
+    # file index of each mid-term feature vector
+    signal_idx = np.concatenate(
+        [i * np.ones((f.shape[0], )) for i, f in enumerate(file_features)
+         if f is not None] + [np.array([])])
+    file_features = [f for f in file_features if f is not None]
+    if len(file_features) > 0:
+        mid_features = np.concatenate(file_features)
+    else:
+        mid_features = np.array([])
 
     return mid_features, signal_idx, wav_file_list
 
 
+""" Feature store """
+
+
+class FeatureStore:
+    """
+    Memory-mapped float32 feature store for (large) training corpora.
+    The feature vectors (rows) are appended one audio file at a time to a
+    preallocated raw float32 matrix ("features.f32", its capacity is doubled
+    when it is full) and a side index ("index.json") keeps the file name,
+    class name, group id and row range of each audio file, along with the
+    feature names and the feature extraction parameters.
+    An existing store is opened (mode="r") as a read-only np.memmap, so the
+    features are used by audioTrainTest without being copied in RAM.
+    ARGUMENTS:
+        - path:           the store directory
+        - mode:           "r" to open an existing store, "w" to create a new
+                          one (call close() when done)
+        - feature_names:  (mode="w") list of feature names
+        - parameters:     (mode="w") dict of feature extraction parameters
+        - capacity:       (mode="w") initial number of rows
+    """
+
+    def __init__(self, path, mode="r", feature_names=None, parameters=None,
+                 capacity=1024):
+        self.path = path
+        self.mode = mode
+        self.features_path = os.path.join(path, "features.f32")
+        self.index_path = os.path.join(path, "index.json")
+        if mode == "r":
+            with open(self.index_path) as fp:
+                self.index = json.load(fp)
+            shape = (self.index["n_rows"], self.index["n_feats"])
+            if shape[0] > 0:
+                self.features = np.memmap(self.features_path,
+                                          dtype=np.float32, mode="r",
+                                          shape=shape)
+            else:
+                self.features = np.zeros(shape, dtype=np.float32)
+        elif mode == "w":
+            os.makedirs(path, exist_ok=True)
+            self.index = {"n_rows": 0, "n_feats": None,
+                          "feature_names": feature_names,
+                          "parameters": parameters or {},
+                          "files": []}
+            self.capacity = max(int(capacity), 1)
+            self.features = None
+        else:
+            raise ValueError("FeatureStore mode must be 'r' or 'w'")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, features, file_name, class_name="", group=None):
+        """
+        Appends the feature vectors (a vector or a n_rows x n_feats matrix)
+        of an audio file to the store
+        """
+        if self.mode != "w":
+            raise ValueError("FeatureStore is not opened for writing")
+        features = np.atleast_2d(features)
+        if isinstance(group, np.generic):
+            group = group.item()
+        if self.features is None:
+            self.index["n_feats"] = features.shape[1]
+            self.features = np.memmap(self.features_path, dtype=np.float32,
+                                      mode="w+",
+                                      shape=(self.capacity,
+                                             features.shape[1]))
+        elif features.shape[1] != self.index["n_feats"]:
+            raise ValueError("FeatureStore: expected {0:d} features, got "
+                             "{1:d}".format(self.index["n_feats"],
+                                            features.shape[1]))
+        start = self.index["n_rows"]
+        end = start + features.shape[0]
+        if end > self.capacity:
+            # grow the (memory-mapped) feature matrix
+            while end > self.capacity:
+                self.capacity *= 2
+            self.features.flush()
+            self.features = np.memmap(self.features_path, dtype=np.float32,
+                                      mode="r+",
+                                      shape=(self.capacity,
+                                             self.index["n_feats"]))
+        self.features[start:end] = features
+        self.index["n_rows"] = end
+        self.index["files"].append({"file": file_name, "class": class_name,
+                                    "group": group, "start": start,
+                                    "end": end})
+
+    def close(self):
+        """
+        Truncates the feature matrix to the rows that have been appended
+        and writes the index (mode="w")
+        """
+        if self.mode != "w":
+            return
+        n_feats = self.index["n_feats"] or 0
+        if self.features is not None:
+            self.features.flush()
+            self.features = None
+        if os.path.isfile(self.features_path):
+            with open(self.features_path, "r+b") as fp:
+                fp.truncate(self.index["n_rows"] * n_feats *
+                            np.dtype(np.float32).itemsize)
+        self.index["n_feats"] = n_feats
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "w") as fp:
+            json.dump(self.index, fp)
+        os.replace(temp_path, self.index_path)
+        self.mode = "closed"
+
+    def class_features(self):
+        """
+        Returns the features of the store per class (in the format used by
+        audioTrainTest.evaluate_classifier). The matrix of a class whose
+        rows are contiguous in the store is a view of the memory-mapped
+        feature matrix (no copy).
+        RETURNS:
+            - features:       list of (n_rows x n_feats) matrices (one per
+                              class, in the order of the first appearance
+                              of each class)
+            - class_names:    list of class names
+            - file_names:     list of lists of file names (one per class)
+            - group_ids:      the group id of each row of the concatenated
+                              features (None if no group ids were stored)
+        """
+        class_names, ranges, file_names = [], {}, {}
+        for entry in self.index["files"]:
+            if entry["class"] not in ranges:
+                class_names.append(entry["class"])
+                ranges[entry["class"]] = []
+                file_names[entry["class"]] = []
+            ranges[entry["class"]].append((entry["start"], entry["end"]))
+            file_names[entry["class"]].append(entry["file"])
+
+        features = []
+        for class_name in class_names:
+            class_ranges = ranges[class_name]
+            contiguous = all(class_ranges[i][1] == class_ranges[i + 1][0]
+                             for i in range(len(class_ranges) - 1))
+            if contiguous:
+                features.append(self.features[class_ranges[0][0]:
+                                              class_ranges[-1][1]])
+            else:
+                features.append(np.concatenate(
+                    [self.features[start:end] for start, end in class_ranges]))
+
+        group_ids = None
+        if all(entry["group"] is not None for entry in self.index["files"]):
+            group_ids = []
+            for class_name in class_names:
+                for entry in self.index["files"]:
+                    if entry["class"] == class_name:
+                        group_ids += [entry["group"]] * (entry["end"] -
+                                                         entry["start"])
+
+        return features, class_names, \
+            [file_names[c] for c in class_names], group_ids
+
+
+def feature_store_extraction(path_list, store_path, mid_window, mid_step,
+                             short_window, short_step, compute_beat=False,
+                             average=True, dict_of_ids=None, n_jobs=1):
+    """
+    Same as multiple_directory_feature_extraction (average=True) or
+    directory_feature_extraction_no_avg (average=False) for a list of class
+    directories, but the feature vectors are written incrementally (one
+    file at a time) to a FeatureStore instead of being kept in RAM.
+    ARGUMENTS:
+        - path_list:             list of class directories
+        - store_path:            the feature store directory
+        - mid_window, mid_step:      mid-term window and step (in seconds)
+        - short_window, short_step:  short-term window and step (in seconds)
+        - compute_beat:          (average=True) append the beat features
+        - average:               one (long-term averaged) feature vector per
+                                 file if True, all the mid-term feature
+                                 vectors of the file otherwise
+        - dict_of_ids:           (opt) dict of file paths to group ids
+        - n_jobs:                number of worker processes
+                                 (see directory_feature_extraction)
+    RETURNS:
+        - store:                 the FeatureStore (opened for reading)
+    """
+
+    parameters = {"mid_window": mid_window, "mid_step": mid_step,
+                  "short_window": short_window, "short_step": short_step,
+                  "compute_beat": compute_beat, "average": average}
+    store = FeatureStore(store_path, "w", parameters=parameters)
+    for d in path_list:
+        class_name = os.path.basename(os.path.normpath(d))
+        if average:
+            types = ('*.wav', '*.aif',  '*.aiff', '*.mp3', '*.au', '*.ogg')
+        else:
+            types = ('*.wav', '*.aif',  '*.aiff', '*.ogg')
+        wav_file_list = []
+        for files in types:
+            wav_file_list.extend(glob.glob(os.path.join(d, files)))
+        wav_file_list = sorted(wav_file_list)
+
+        if average:
+            batches = map_file_batches(directory_batch_features,
+                                       wav_file_list, n_jobs, mid_window,
+                                       mid_step, short_window, short_step,
+                                       compute_beat)
+        else:
+            batches = map_file_batches(directory_batch_features_no_avg,
+                                       wav_file_list, n_jobs, mid_window,
+                                       mid_step, short_window, short_step)
+        for i, result in enumerate(batches):
+            print("Analyzing files {0:d}-{1:d} of {2:d}: {3:s}".format(
+                i * FILE_BATCH_SIZE + 1,
+                min((i + 1) * FILE_BATCH_SIZE, len(wav_file_list)),
+                len(wav_file_list), d))
+            batch_files = wav_file_list[i * FILE_BATCH_SIZE:
+                                        (i + 1) * FILE_BATCH_SIZE]
+            if average:
+                features, feature_files, names, messages = result[0], \
+                    result[1], result[4], result[3]
+            else:
+                feature_files = batch_files
+                features, names, messages = result
+            print_batch_messages(batch_files, messages, i * FILE_BATCH_SIZE,
+                                 len(wav_file_list), skipped_only=True)
+            if len(features) > 0 and names:
+                store.index["feature_names"] = names
+            for file_path, file_features in zip(feature_files, features):
+                if file_features is None:
+                    continue
+                group = dict_of_ids[file_path] if dict_of_ids else None
+                store.append(file_features, file_path, class_name, group)
+    store.close()
+    return FeatureStore(store_path)
+
+
 """
 The following two feature extraction wrappers extract features for given audio
 files, however  NO LONG-TERM AVERAGING is performed. Therefore, the output for
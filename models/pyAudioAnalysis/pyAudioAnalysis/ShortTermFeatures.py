@@ -1,7 +1,10 @@
 from __future__ import print_function
 import math
+import functools
+import collections
 import numpy as np
 import sys
+import scipy.fft
 from scipy.fftpack import fft
 import matplotlib.pyplot as plt
 from scipy.signal import lfilter
@@ -19,6 +22,19 @@ def dc_normalize(sig_array):
     return sig_array_norm
 
 
+def normalization_constants(signal, dtype=np.float64):
+    """
+    Returns the (dc, peak) constants that dc_normalize() applies to an int16
+    signal in feature_extraction(), so that a ShortTermFeatureStream can
+    reproduce its features when the whole signal is known in advance
+    """
+    signal = np.asarray(signal, dtype=dtype) / (2.0 ** 15)
+    if signal.shape[0] == 0:
+        return signal.dtype.type(0), signal.dtype.type(0)
+    dc = signal.mean()
+    return dc, abs(signal - dc).max()
+
+
 def zero_crossing_rate(frame):
     """Computes zero crossing rate of frame"""
     count = len(frame)
@@ -144,7 +160,7 @@ def harmonic(frame, sampling_rate):
     """
     Computes harmonic ratio and pitch
     """
-    m = np.round(0.016 * sampling_rate) - 1
+    m = int(np.round(0.016 * sampling_rate)) - 1
     r = np.correlate(frame, frame, mode='full')
 
     g = r[len(frame) - 1]
@@ -259,47 +275,89 @@ def chroma_features_init(num_fft, sampling_rate):
     This function initializes the chroma matrices used in the calculation
     of the chroma features
     """
-    freqs = np.array([((f + 1) * sampling_rate) /
-                      (2 * num_fft) for f in range(num_fft)])
+    freqs = ((np.arange(num_fft) + 1) * sampling_rate) / (2 * num_fft)
     cp = 27.50
     num_chroma = np.round(12.0 * np.log2(freqs / cp)).astype(int)
 
-    num_freqs_per_chroma = np.zeros((num_chroma.shape[0],))
-
-    unique_chroma = np.unique(num_chroma)
-    for u in unique_chroma:
-        idx = np.nonzero(num_chroma == u)
-        num_freqs_per_chroma[idx] = idx[0].shape
+    _, inverse, counts = np.unique(num_chroma, return_inverse=True,
+                                   return_counts=True)
+    num_freqs_per_chroma = counts[inverse].astype(np.float64)
 
     return num_chroma, num_freqs_per_chroma
 
 
-def chroma_features(signal, sampling_rate, num_fft):
-    # TODO: 1 complexity
-    # TODO: 2 bug with large windows
+""" Spectral tables cache """
+
+SpectralTables = collections.namedtuple(
+    "SpectralTables", ["fbank", "freqs", "num_chroma",
+                       "num_freqs_per_chroma", "chroma_matrix"])
 
+
+def chroma_matrix_init(num_chroma, num_freqs_per_chroma):
+    """
+    Builds the (num_fft x 12) matrix that maps a power spectrum to the
+    (unnormalized) 12 chroma bins, so that the chroma features of a batch of
+    frames are a single matrix product. The matrix reproduces the
+    scatter / fold procedure of the original chroma_features() function.
+    """
+    n_bins = num_chroma.shape[0]
+    bins = np.nonzero(num_chroma < n_bins)[0]
+    positions = num_chroma[bins] % n_bins
+    # when several fft bins fall in the same chroma position, the last one
+    # is kept (as in a numpy scatter assignment)
+    _, last = np.unique(positions[::-1], return_index=True)
+    keep = len(positions) - 1 - last
+    bins, positions = bins[keep], positions[keep]
+
+    divisor = num_freqs_per_chroma[np.minimum(num_chroma, n_bins - 1)]
+    matrix = np.zeros((n_bins, 12))
+    np.add.at(matrix, (bins, positions % 12), 1.0 / divisor[positions])
+    return matrix
+
+
+@functools.lru_cache(maxsize=32)
+def spectral_tables(sampling_rate, num_fft, dtype=np.float64):
+    """
+    Returns the (read-only) filterbank and chroma tables for a given
+    sampling rate and fft size. Results are kept in an LRU cache, so the
+    tables are only computed once per (sampling_rate, num_fft) pair.
+    The fbank and chroma_matrix tables are stored in the requested
+    floating point dtype.
+    RETURNS
+        a SpectralTables named tuple with the following fields:
+        fbank:                the MFCC triangular filterbank (40 x num_fft)
+        freqs:                the filterbank frequency points
+        num_chroma:           the chroma index of each fft bin
+        num_freqs_per_chroma: the chroma normalization of each fft bin
+        chroma_matrix:        the (num_fft x 12) power-to-chroma matrix
+    """
+    fbank, freqs = mfcc_filter_banks(sampling_rate, num_fft)
     num_chroma, num_freqs_per_chroma = \
         chroma_features_init(num_fft, sampling_rate)
+    chroma_matrix = chroma_matrix_init(num_chroma, num_freqs_per_chroma)
+    tables = SpectralTables(fbank.astype(dtype), freqs, num_chroma,
+                            num_freqs_per_chroma, chroma_matrix.astype(dtype))
+    for table in tables:
+        table.setflags(write=False)
+    return tables
+
+
+def warm_spectral_tables(configurations, dtype=np.float64):
+    """
+    Precomputes the spectral tables for a list of
+    (sampling_rate, window) pairs (window in samples), e.g. at process start:
+        warm_spectral_tables([(16000, 320), (16000, 800)])
+    """
+    for sampling_rate, window in configurations:
+        spectral_tables(sampling_rate, int(int(window) / 2), dtype)
+
+
+def chroma_features(signal, sampling_rate, num_fft):
     chroma_names = ['A', 'A#', 'B', 'C', 'C#', 'D',
                     'D#', 'E', 'F', 'F#', 'G', 'G#']
+    chroma_matrix = spectral_tables(sampling_rate, num_fft).chroma_matrix
     spec = signal ** 2
-    if num_chroma.max() < num_chroma.shape[0]:
-        C = np.zeros((num_chroma.shape[0],))
-        C[num_chroma] = spec
-        C /= num_freqs_per_chroma[num_chroma]
-    else:
-        I = np.nonzero(num_chroma > num_chroma.shape[0])[0][0]
-        C = np.zeros((num_chroma.shape[0],))
-        C[num_chroma[0:I - 1]] = spec
-        C /= num_freqs_per_chroma
-    final_matrix = np.zeros((12, 1))
-    newD = int(np.ceil(C.shape[0] / 12.0) * 12)
-    C2 = np.zeros((newD,))
-    C2[0:C.shape[0]] = C
-    C2 = C2.reshape(int(C2.shape[0] / 12), 12)
-    # for i in range(12):
-    #    finalC[i] = np.sum(C[i:C.shape[0]:12])
-    final_matrix = np.sum(C2, axis=0).reshape(1, -1).T
+    final_matrix = np.dot(spec, chroma_matrix).reshape(1, -1).T
 
     spec_sum = spec.sum()
     if spec_sum == 0:
@@ -307,56 +365,65 @@ def chroma_features(signal, sampling_rate, num_fft):
     else:
         final_matrix /= spec_sum
 
-    #    ax = plt.gca()
-    #    plt.hold(False)
-    #    plt.plot(finalC)
-    #    ax.set_xticks(range(len(chromaNames)))
-    #    ax.set_xticklabels(chromaNames)
-    #    xaxis = np.arange(0, 0.02, 0.01);
-    #    ax.set_yticks(range(len(xaxis)))
-    #    ax.set_yticklabels(xaxis)
-    #    plt.show(block=False)
-    #    plt.draw()
-
     return chroma_names, final_matrix
 
 
+def short_term_output(out, shape, dtype):
+    """
+    Returns the output buffer of spectrogram() / chromagram(): either a new
+    zero matrix or the (validated) caller-provided out buffer
+    """
+    if out is None:
+        return np.zeros(shape, dtype=dtype)
+    if out.shape != shape or out.dtype != np.dtype(dtype):
+        raise ValueError("out buffer must be of shape {0} and dtype {1} "
+                         "(got {2}, {3})".format(shape, np.dtype(dtype),
+                                                 out.shape, out.dtype))
+    return out
+
+
 def chromagram(signal, sampling_rate, window, step, plot=False,
-               show_progress=False):
+               show_progress=False, dtype=np.float64, window_function=None,
+               out=None):
     """
-    Short-term FFT mag for spectogram estimation:
+    Short-term chroma features for chromagram estimation:
     Returns:
-        a np array (num_fft x numOfShortTermWindows)
+        a np array (numOfShortTermWindows x 12)
     ARGUMENTS:
         signal:      the input signal samples
         sampling_rate:          the sampling freq (in Hz)
         window:         the short-term window size (in samples)
         step:        the short-term window step (in samples)
         plot:        flag, 1 if results are to be ploted
+        show_progress flag for showing progress using tqdm
+        dtype:       (opt) floating point type of the computation
+                     (np.float64 or np.float32)
+        window_function: (opt) window applied to each frame before the FFT:
+                     a function of the window length (e.g. np.hamming) or
+                     an array of window samples (default: rectangular)
+        out:         (opt) preallocated (numOfShortTermWindows x 12) output
+                     matrix of the given dtype
     RETURNS:
     """
     window = int(window)
     step = int(step)
-    signal = np.double(signal)
+    signal = np.asarray(signal, dtype=dtype)
     signal = signal / (2.0 ** 15)
     signal = dc_normalize(signal)
 
-    num_samples = len(signal)  # total number of signals
-    count_fr = 0
     num_fft = int(window / 2)
-    chromogram = np.zeros((int((num_samples-step-window) / step) + 1, 12),
-                          dtype=np.float64)
-    for cur_p in tqdm(range(window, num_samples - step, step),
+    frames = frame_matrix(signal, window, step)
+    chromogram = short_term_output(out, (frames.shape[0], 12), dtype)
+    for start in tqdm(range(0, frames.shape[0], FRAME_BLOCK_SIZE),
                       disable=not show_progress):
-        count_fr += 1
-        x = signal[cur_p:cur_p + window]
-        X = abs(fft(x))
-        X = X[0:num_fft]
-        X = X / len(X)
-        chroma_names, chroma_feature_matrix = chroma_features(X, sampling_rate,
-                                                              num_fft)
-        chroma_feature_matrix = chroma_feature_matrix[:, 0]
-        chromogram[count_fr-1, :] = chroma_feature_matrix.T
+        end = min(start + FRAME_BLOCK_SIZE, frames.shape[0])
+        fft_magnitude = fft_magnitude_frames(frames[start:end],
+                                             window_function)
+        chromogram[start:end] = chroma_features_frames(fft_magnitude,
+                                                       sampling_rate, num_fft)
+    count_fr = chromogram.shape[0]
+    chroma_names = ['A', 'A#', 'B', 'C', 'C#', 'D',
+                    'D#', 'E', 'F', 'F#', 'G', 'G#']
     freq_axis = chroma_names
     time_axis = [(t * step) / sampling_rate
                  for t in range(chromogram.shape[0])]
@@ -387,7 +454,8 @@ def chromagram(signal, sampling_rate, window, step, plot=False,
 
 
 def spectrogram(signal, sampling_rate, window, step, plot=False,
-                show_progress=False):
+                show_progress=False, dtype=np.float64, window_function=None,
+                out=None):
     """
     Short-term FFT mag for spectogram estimation:
     Returns:
@@ -399,27 +467,30 @@ def spectrogram(signal, sampling_rate, window, step, plot=False,
         step:           the short-term window step (in samples)
         plot:           flag, 1 if results are to be ploted
         show_progress flag for showing progress using tqdm
+        dtype:          (opt) floating point type of the computation
+                        (np.float64 or np.float32)
+        window_function: (opt) window applied to each frame before the FFT:
+                        a function of the window length (e.g. np.hamming)
+                        or an array of window samples (default: rectangular)
+        out:            (opt) preallocated (numOfShortTermWindows x num_fft)
+                        output matrix of the given dtype
     RETURNS:
     """
     window = int(window)
     step = int(step)
-    signal = np.double(signal)
+    signal = np.asarray(signal, dtype=dtype)
     signal = signal / (2.0 ** 15)
     signal = dc_normalize(signal)
 
-    num_samples = len(signal)  # total number of signals
-    count_fr = 0
     num_fft = int(window / 2)
-    specgram = np.zeros((int((num_samples-window) / step) + 1, num_fft),
-                        dtype=np.float64)
-    for cur_p in tqdm(range(window, num_samples - window + 1, step),
+    frames = frame_matrix(signal, window, step)
+    specgram = short_term_output(out, (frames.shape[0], num_fft), dtype)
+    for start in tqdm(range(0, frames.shape[0], FRAME_BLOCK_SIZE),
                       disable=not show_progress):
-        count_fr += 1
-        x = signal[cur_p:cur_p + window]
-        X = abs(fft(x))
-        X = X[0:num_fft]
-        X = X / len(X)
-        specgram[count_fr-1, :] = X
+        end = min(start + FRAME_BLOCK_SIZE, frames.shape[0])
+        specgram[start:end] = fft_magnitude_frames(frames[start:end],
+                                                   window_function)
+    count_fr = specgram.shape[0]
 
     freq_axis = [float((f + 1) * sampling_rate) / (2 * num_fft)
                  for f in range(specgram.shape[1])]
@@ -448,67 +519,35 @@ def spectrogram(signal, sampling_rate, window, step, plot=False,
         imgplot.set_cmap('jet')
         plt.colorbar()
         plt.show()
-    print(specgram.shape)
     return specgram, time_axis, freq_axis
 
 
 # TODO
 def speed_feature(signal, sampling_rate, window, step):
+    """
+    Returns the (harmonic ratio, pitch) pair of each short-term window
+    (a numOfShortTermWindows x 2 matrix), see harmonic_frames()
+    """
     signal = np.double(signal)
     signal = signal / (2.0 ** 15)
     signal = dc_normalize(signal)
 
-    num_samples = len(signal)  # total number of signals
-    cur_p = 0
-    count_fr = 0
-
-    lowfreq = 133.33
-    linsc = 200 / 3.
-    logsc = 1.0711703
-    nlinfil = 13
-    nlogfil = 27
-    n_mfcc_feats = 13
-    nfil = nlinfil + nlogfil
-    num_fft = window / 2
-    if sampling_rate < 8000:
-        nlogfil = 5
-        nfil = nlinfil + nlogfil
-        num_fft = window / 2
-
-    # compute filter banks for mfcc:
-    fbank, freqs = mfcc_filter_banks(sampling_rate, num_fft, lowfreq, linsc,
-                                       logsc, nlinfil, nlogfil)
-
-    n_time_spectral_feats = 8
-    n_harmonic_feats = 1
-    n_total_feats = n_time_spectral_feats + n_mfcc_feats + n_harmonic_feats
-    # st_features = np.array([], dtype=np.float64)
-    st_features = []
-
-    while cur_p + window - 1 < num_samples:
-        count_fr += 1
-        x = signal[cur_p:cur_p + window]
-        cur_p = cur_p + step
-        fft_magnitude = abs(fft(x))
-        fft_magnitude = fft_magnitude[0:num_fft]
-        fft_magnitude = fft_magnitude / len(fft_magnitude)
-        Ex = 0.0
-        El = 0.0
-        fft_magnitude[0:4] = 0
-        #        M = np.round(0.016 * fs) - 1
-        #        R = np.correlate(frame, frame, mode='full')
-        st_features.append(harmonic(x, sampling_rate))
-    #        for i in range(len(X)):
-    # if (i < (len(X) / 8)) and (i > (len(X)/40)):
-    #    Ex += X[i]*X[i]
-    # El += X[i]*X[i]
-    #        st_features.append(Ex / El)
-    #        st_features.append(np.argmax(X))
-    #        if curFV[n_time_spectral_feats+n_mfcc_feats+1]>0:
-    #            print curFV[n_time_spectral_feats+n_mfcc_feats],
-    #            curFV[n_time_
-    #            spectral_feats+n_mfcc_feats+1]
-    return np.array(st_features)
+    frames = frame_matrix(signal, window, step)
+    hr, f0 = harmonic_frames(frames, sampling_rate)
+    return np.column_stack((hr, f0))
+
+
+def lpc(signal, order):
+    """
+    Computes the LPC coefficients of a signal (autocorrelation method,
+    Levinson-Durbin recursion)
+    RETURNS
+        a:      the prediction polynomial (a[0] = 1, order + 1 coefficients)
+        e:      the prediction error
+        k:      the reflection coefficients
+    """
+    a, e, k = lpc_frames(np.asarray(signal).reshape(1, -1), order)
+    return a[0], e[0], k[0]
 
 
 def phormants(x, sampling_rate):
@@ -520,7 +559,7 @@ def phormants(x, sampling_rate):
     x1 = lfilter([1], [1., 0.63], x1)
 
     # Get LPC.
-    ncoeff = 2 + sampling_rate / 1000
+    ncoeff = int(2 + sampling_rate / 1000)
     A, e, k = lpc(x1, ncoeff)
     # A, e, k = lpc(x1, 8)
 
@@ -537,15 +576,426 @@ def phormants(x, sampling_rate):
     return frqs
 
 
-""" Windowing and feature extraction """
+""" Batched (frame-matrix) feature computation """
+
+# number of short-term frames that are processed in one vectorized pass
+# (bounds the size of the intermediate FFT matrix for long recordings)
+FRAME_BLOCK_SIZE = 4096
+
+
+def frame_matrix(signal, window, step):
+    """
+    Returns a read-only strided view of the signal, of size
+    (n_frames x window), whose i-th row is the i-th short-term window.
+    No samples are copied.
+    """
+    window = int(window)
+    step = int(step)
+    if len(signal) < window:
+        return np.zeros((0, window), dtype=signal.dtype)
+    return np.lib.stride_tricks.sliding_window_view(signal, window)[::step]
+
+
+def fft_magnitude_frames(frames, window_function=None):
+    """
+    Computes the normalized abs(FFT) (first window / 2 bins) of each row of a
+    frame matrix with one batched real FFT. window_function is an optional
+    window (a function of the window length, e.g. np.hamming, or an array)
+    applied to each frame before the FFT.
+    """
+    num_fft = int(frames.shape[1] / 2)
+    if window_function is not None:
+        if callable(window_function):
+            window_function = window_function(frames.shape[1])
+        frames = frames * np.asarray(window_function, dtype=frames.dtype)
+    fft_magnitude = np.abs(scipy.fft.rfft(frames, axis=1))[:, 0:num_fft]
+    return fft_magnitude / num_fft
+
+
+def zero_crossing_rate_frames(frames):
+    """Computes zero crossing rate of each row of a frame matrix"""
+    count_zero = np.sum(np.abs(np.diff(np.sign(frames), axis=1)), axis=1) / 2
+    return count_zero / (frames.shape[1] - 1.0)
+
+
+def energy_frames(frames):
+    """Computes signal energy of each row of a frame matrix"""
+    return np.sum(frames ** 2, axis=1) / float(frames.shape[1])
+
+
+def block_entropy_frames(frames, n_short_blocks=10):
+    """
+    Computes the entropy of the normalized sub-block energies of each row
+    of a frame matrix (energy entropy when applied on time frames,
+    spectral entropy when applied on fft magnitudes)
+    """
+    total_energy = np.sum(frames ** 2, axis=1)
+    sub_win_len = int(np.floor(frames.shape[1] / n_short_blocks))
+    sub_wins = frames[:, 0:sub_win_len * n_short_blocks].reshape(
+        frames.shape[0], n_short_blocks, sub_win_len)
+    s = np.sum(sub_wins ** 2, axis=2) / (total_energy[:, None] + eps)
+    return -np.sum(s * np.log2(s + eps), axis=1)
+
+
+def spectral_centroid_spread_frames(fft_magnitude, sampling_rate):
+    """
+    Computes spectral centroid and spread of each row of an
+    abs(FFT) matrix (n_frames x num_fft)
+    """
+    num_fft = fft_magnitude.shape[1]
+    ind = (np.arange(1, num_fft + 1)) * (sampling_rate / (2.0 * num_fft))
+    ind = ind.astype(fft_magnitude.dtype)
 
+    Xt_max = fft_magnitude.max(axis=1, keepdims=True)
+    Xt = fft_magnitude / np.where(Xt_max == 0, eps, Xt_max)
 
-def feature_extraction(signal, sampling_rate, window, step, deltas=True):
+    NUM = np.dot(Xt, ind)
+    DEN = np.sum(Xt, axis=1) + eps
+
+    centroid = NUM / DEN
+    spread = np.sqrt(np.sum(((ind[None, :] - centroid[:, None]) ** 2) * Xt,
+                            axis=1) / DEN)
+
+    centroid = centroid / (sampling_rate / 2.0)
+    spread = spread / (sampling_rate / 2.0)
+    return centroid, spread
+
+
+def spectral_flux_frames(fft_magnitude, previous_fft_magnitude=None,
+                         reset_rows=None):
+    """
+    Computes the spectral flux of each row of an abs(FFT) matrix with respect
+    to the previous row. The first row is compared against
+    previous_fft_magnitude (or against itself if that is None), as are the
+    rows listed in reset_rows (e.g. the first frames of packed signals).
+    """
+    if previous_fft_magnitude is None:
+        previous_fft_magnitude = fft_magnitude[0]
+    fft_sum = np.sum(fft_magnitude + eps, axis=1, keepdims=True)
+    normalized = fft_magnitude / fft_sum
+    previous = np.empty_like(normalized)
+    previous[0] = previous_fft_magnitude / np.sum(previous_fft_magnitude + eps)
+    previous[1:] = normalized[:-1]
+    if reset_rows is not None:
+        previous[reset_rows] = normalized[reset_rows]
+    return np.sum((normalized - previous) ** 2, axis=1)
+
+
+def spectral_rolloff_frames(fft_magnitude, c):
+    """Computes spectral roll-off of each row of an abs(FFT) matrix"""
+    power = fft_magnitude ** 2
+    threshold = c * np.sum(power, axis=1, keepdims=True)
+    above = (np.cumsum(power, axis=1) + eps) > threshold
+    first = np.argmax(above, axis=1)
+    rolloff = first.astype(fft_magnitude.dtype) / fft_magnitude.shape[1]
+    rolloff[~above.any(axis=1)] = 0.0
+    return rolloff
+
+
+def harmonic_frames(frames, sampling_rate):
+    """
+    Computes harmonic ratio and pitch of each row of a frame matrix, i.e. the
+    batched equivalent of harmonic(). The autocorrelations of all frames are
+    computed at once via the FFT (Wiener-Khinchin), instead of one O(N^2)
+    np.correlate per frame.
+    RETURNS
+        hr:     harmonic ratio of each frame (n_frames,)
+        f0:     fundamental frequency (Hz) of each frame, 0 for unvoiced
+                frames (n_frames,)
+    """
+    n_frames, frame_length = frames.shape
+    m = int(np.round(0.016 * sampling_rate)) - 1
+    if n_frames == 0:
+        return np.zeros((0,), dtype=frames.dtype), \
+            np.zeros((0,), dtype=frames.dtype)
+
+    # autocorrelation of all frames (lags 0 .. frame_length - 1)
+    n_fft = scipy.fft.next_fast_len(2 * frame_length - 1, real=True)
+    spectrum = scipy.fft.rfft(frames, n=n_fft, axis=1)
+    autocorrelation = scipy.fft.irfft(spectrum.real ** 2 + spectrum.imag ** 2,
+                                      n=n_fft, axis=1)[:, 0:frame_length]
+    g = autocorrelation[:, 0]
+    r = autocorrelation[:, 1:frame_length - 1]
+
+    # estimate m0 (as the first zero crossing of R)
+    crossings = np.diff(np.sign(r), axis=1) != 0
+    m0 = np.where(crossings.any(axis=1), np.argmax(crossings, axis=1),
+                  r.shape[1] - 1)
+    if m > r.shape[1]:
+        m = r.shape[1] - 1
+
+    cumulative_sum = np.cumsum(frames ** 2, axis=1)
+    lags = np.arange(m)
+    valid = lags[None, :] >= m0[:, None]
+    energy_index = np.clip(m + m0[:, None] - lags[None, :], 0,
+                           frame_length - 1)
+    gamma = r[:, 0:m] / (np.sqrt(g[:, None] * np.take_along_axis(
+        cumulative_sum, energy_index, axis=1)) + eps)
+    gamma = np.where(valid, gamma, 0.0)
+
+    if m == 0:
+        hr = np.ones((n_frames,))
+        blag = np.zeros((n_frames,))
+        zcr = np.zeros((n_frames,))
+    else:
+        zcr = zero_crossing_rate_frames(gamma)
+        hr = gamma.max(axis=1)
+        blag = np.argmax(gamma, axis=1)
+
+    # get fundamental frequency:
+    f0 = sampling_rate / (blag + eps)
+    f0[(f0 > 5000) | (hr < 0.1)] = 0.0
+    unvoiced = zcr > 0.15
+    hr = np.where(unvoiced, 0.0, hr)
+    f0[unvoiced] = 0.0
+    return hr.astype(frames.dtype), f0.astype(frames.dtype)
+
+
+def lpc_frames(frames, order):
+    """
+    Computes the LPC coefficients of each row of a frame matrix. The
+    autocorrelations of all frames are computed via the FFT and the
+    Levinson-Durbin recursion runs on all frames at once.
+    RETURNS
+        a:      (n_frames x order + 1) prediction polynomials (a[:, 0] = 1)
+        e:      (n_frames,) prediction errors
+        k:      (n_frames x order) reflection coefficients
+    """
+    n_frames, frame_length = frames.shape
+    n_fft = scipy.fft.next_fast_len(frame_length + order, real=True)
+    spectrum = scipy.fft.rfft(frames, n=n_fft, axis=1)
+    r = scipy.fft.irfft(spectrum.real ** 2 + spectrum.imag ** 2,
+                        n=n_fft, axis=1)[:, 0:order + 1]
+
+    a = np.zeros((n_frames, order + 1), dtype=r.dtype)
+    a[:, 0] = 1.0
+    k = np.zeros((n_frames, order), dtype=r.dtype)
+    e = r[:, 0].copy()
+    for i in range(1, order + 1):
+        acc = np.einsum("ij,ij->i", a[:, 0:i], r[:, i:0:-1])
+        k_i = -acc / (e + eps)
+        a[:, 1:i] = a[:, 1:i] + k_i[:, None] * a[:, i - 1:0:-1]
+        a[:, i] = k_i
+        e = e * (1.0 - k_i ** 2)
+        k[:, i - 1] = k_i
+    return a, e, k
+
+
+def formants_frames(frames, sampling_rate, n_formants=4):
+    """
+    Computes the formant frequencies of each row of a frame matrix, i.e. the
+    batched equivalent of phormants(): all frames are windowed and
+    pre-emphasized together, their LPC polynomials are computed with a
+    batched Levinson-Durbin recursion and the roots of all polynomials are
+    found with a single (stacked) companion-matrix eigenvalue call.
+    RETURNS
+        (n_frames x n_formants) matrix of the n_formants lowest frequencies
+        (in Hz) returned by phormants() for each frame (zero-padded if the
+        LPC order of low sampling rates yields fewer formants)
+    """
+    n_frames, frame_length = frames.shape
+    order = int(2 + sampling_rate / 1000)
+    # at least ceil(order / 2) roots have a non-negative imaginary part
+    n_roots = min(n_formants, int(np.ceil(order / 2.0)))
+    formants = np.zeros((n_frames, n_formants), dtype=frames.dtype)
+    if n_frames == 0:
+        return formants
+
+    # apply window and high pass filter
+    x1 = frames * np.hamming(frame_length)
+    x1 = lfilter([1], [1., 0.63], x1, axis=1)
+
+    a, _, _ = lpc_frames(x1, order)
+
+    # roots of all polynomials (eigenvalues of the companion matrices)
+    companion = np.zeros((n_frames, order, order))
+    companion[:, 0, :] = -a[:, 1:]
+    companion[:, np.arange(1, order), np.arange(order - 1)] = 1.0
+    rts = np.linalg.eigvals(companion)
+
+    # get frequencies of the roots with non-negative imaginary part
+    frqs = np.arctan2(rts.imag, rts.real) * (sampling_rate / (2 * math.pi))
+    frqs[rts.imag < 0] = np.inf
+    formants[:, 0:n_roots] = np.sort(frqs, axis=1)[:, 0:n_roots]
+    return formants
+
+
+def mfcc_frames(fft_magnitude, fbank, num_mfcc_feats):
+    """
+    Computes the MFCCs of each row of an abs(FFT) matrix
+    (n_frames x num_mfcc_feats)
+    """
+    mspec = np.log10(np.dot(fft_magnitude, fbank.T) + eps)
+    return dct(mspec, type=2, norm='ortho', axis=-1)[:, :num_mfcc_feats]
+
+
+def chroma_features_frames(fft_magnitude, sampling_rate, num_fft):
+    """
+    Computes the 12 chroma features of each row of an abs(FFT) matrix
+    (n_frames x 12), i.e. the batched equivalent of chroma_features()
+    """
+    chroma_matrix = spectral_tables(sampling_rate, num_fft,
+                                    fft_magnitude.dtype.type).chroma_matrix
+    spec = fft_magnitude ** 2
+    final_matrix = np.dot(spec, chroma_matrix)
+
+    spec_sum = spec.sum(axis=1, keepdims=True)
+    final_matrix /= np.where(spec_sum == 0, eps, spec_sum)
+    return final_matrix
+
+
+""" Windowing and feature extraction """
+
+# short-term feature groups (and respective feature names), in the order
+# in which they appear in the output of feature_extraction()
+FEATURE_GROUPS = collections.OrderedDict([
+    ("time", ["zcr", "energy", "energy_entropy"]),
+    ("spectral", ["spectral_centroid", "spectral_spread",
+                  "spectral_entropy", "spectral_flux", "spectral_rolloff"]),
+    ("mfcc", ["mfcc_{0:d}".format(mfcc_i) for mfcc_i in range(1, 14)]),
+    ("chroma", ["chroma_{0:d}".format(chroma_i) for chroma_i in range(1, 13)]
+     + ["chroma_std"]),
+    ("harmonic", ["harmonic_ratio", "f0"]),
+    ("formants", ["formant_{0:d}".format(formant_i)
+                  for formant_i in range(1, 5)]),
+])
+
+# feature groups computed by default (optional groups are opt-in only)
+DEFAULT_FEATURE_GROUPS = ["time", "spectral", "mfcc", "chroma"]
+
+
+def feature_groups(features=None):
+    """
+    Validates a selection of short-term feature groups and returns it as a
+    list in canonical order. features can be None (DEFAULT_FEATURE_GROUPS),
+    a single group name or an iterable of group names (see FEATURE_GROUPS).
+    """
+    if features is None:
+        return list(DEFAULT_FEATURE_GROUPS)
+    if isinstance(features, str):
+        features = [features]
+    features = set(features)
+    unknown = features.difference(FEATURE_GROUPS)
+    if unknown:
+        raise ValueError("Unknown feature group(s) {0}, valid groups are "
+                         "{1}".format(sorted(unknown), list(FEATURE_GROUPS)))
+    return [g for g in FEATURE_GROUPS if g in features]
+
+
+def frame_features(frames, sampling_rate, groups, previous_fft_magnitude=None,
+                   reset_rows=None):
+    """
+    Computes the selected short-term feature groups for every row of a
+    (normalized) frame matrix. The FFT is skipped when only time-domain
+    features are requested.
+    ARGUMENTS
+        frames:                  a (n_frames x window) frame matrix
+        sampling_rate:           the sampling freq (in Hz)
+        groups:                  list of feature groups (see feature_groups())
+        previous_fft_magnitude:  (opt) abs(FFT) of the frame preceding the
+                                 first row (used in spectral flux)
+        reset_rows:              (opt) rows that start a new signal (their
+                                 spectral flux is zero)
+    RETURNS
+        features:                (n_feats x n_frames) feature matrix
+        fft_magnitude:           abs(FFT) of the last row (None if no
+                                 frequency-domain feature was computed)
+    """
+    num_fft = int(frames.shape[1] / 2)
+    # first row of each feature group in the output matrix
+    rows = {}
+    n_feats = 0
+    for g in groups:
+        rows[g] = n_feats
+        n_feats += len(FEATURE_GROUPS[g])
+    features = np.zeros((n_feats, frames.shape[0]), dtype=frames.dtype)
+    if frames.shape[0] == 0:
+        return features, previous_fft_magnitude
+
+    if "time" in groups:
+        row = rows["time"]
+        features[row] = zero_crossing_rate_frames(frames)
+        features[row + 1] = energy_frames(frames)
+        features[row + 2] = block_entropy_frames(frames)
+
+    if "harmonic" in groups:
+        row = rows["harmonic"]
+        features[row], features[row + 1] = harmonic_frames(frames,
+                                                           sampling_rate)
+
+    if "formants" in groups:
+        row = rows["formants"]
+        n_formants = len(FEATURE_GROUPS["formants"])
+        features[row:row + n_formants] = \
+            formants_frames(frames, sampling_rate, n_formants).T
+
+    if not set(groups).intersection(["spectral", "mfcc", "chroma"]):
+        return features, None
+
+    # get (normalized) fft magnitude of all frames
+    fft_magnitude = fft_magnitude_frames(frames)
+    if fft_magnitude.dtype == np.float32:
+        # the spectrum of a constant (digitally silent) frame is its DC bin:
+        # the single precision round-off of the other bins (~1e-14, far
+        # above the eps floor of the log mel energies) is zeroed
+        constant = np.flatnonzero(frames.min(axis=1) == frames.max(axis=1))
+        fft_magnitude[constant, 1:] = 0
+
+    if "spectral" in groups:
+        row = rows["spectral"]
+        features[row], features[row + 1] = \
+            spectral_centroid_spread_frames(fft_magnitude, sampling_rate)
+        features[row + 2] = block_entropy_frames(fft_magnitude)
+        features[row + 3] = spectral_flux_frames(fft_magnitude,
+                                                 previous_fft_magnitude,
+                                                 reset_rows)
+        features[row + 4] = spectral_rolloff_frames(fft_magnitude, 0.90)
+
+    if "mfcc" in groups:
+        row = rows["mfcc"]
+        n_mfcc_feats = len(FEATURE_GROUPS["mfcc"])
+        fbank = spectral_tables(sampling_rate, num_fft,
+                                frames.dtype.type).fbank
+        features[row:row + n_mfcc_feats] = \
+            mfcc_frames(fft_magnitude, fbank, n_mfcc_feats).T
+
+    if "chroma" in groups:
+        row = rows["chroma"]
+        chroma = chroma_features_frames(fft_magnitude, sampling_rate, num_fft)
+        features[row:row + 12] = chroma.T
+        features[row + 12] = chroma.std(axis=1)
+
+    return features, fft_magnitude[-1]
+
+
+def feature_extraction(signal, sampling_rate, window, step, deltas=True,
+                       features=None, dtype=np.float64):
     """
     This function implements the shor-term windowing process.
     For each short-term window a set of features is extracted.
     This results to a sequence of feature vectors, stored in a np matrix.
 
+    The signal is viewed as a strided (n_frames x window) frame matrix and
+    all features are computed column-wise, in blocks of FRAME_BLOCK_SIZE
+    frames, using one batched real FFT per block. The results match the
+    per-frame feature functions of this module to within 1e-8 (absolute,
+    floating point round-off of the FFT implementations).
+
+    With dtype=np.float32 the whole computation (signal, FFT, filterbank and
+    chroma products, deltas) is carried out in single precision, which
+    halves the memory traffic. Compared to the float64 path, the float32
+    features of broadband audio (speech, music, noise) differ (in absolute
+    value) by about 1e-6 for the time, spectral and chroma features and by
+    a few 1e-5 for the MFCCs (and their deltas). Digitally silent frames
+    agree as well (their spectrum is set to the exact DC-only spectrum).
+    Two cases exceed these bounds: the spectral rolloff (a bin index) may
+    move by one bin (1 / (window / 2)) when the 90% point is at a bin edge,
+    and mel bands more than ~140 dB below the rest of the frame's spectrum
+    (which only occur in synthetic signals, e.g. pure or exactly periodic
+    digital tones) are below the single precision resolution of the FFT,
+    so the MFCCs of such frames may differ by 0.01 to more than 10 (and
+    their spectral spread by ~1e-5). Use float64 for such signals.
+
     ARGUMENTS
         signal:         the input signal samples
         sampling_rate:  the sampling freq (in Hz)
@@ -553,6 +1003,14 @@ def feature_extraction(signal, sampling_rate, window, step, deltas=True):
         step:           the short-term window step (in samples)
         deltas:         (opt) True/False if delta features are to be
                         computed
+        features:       (opt) the feature groups to be computed, any of
+                        "time", "spectral", "mfcc", "chroma", "harmonic"
+                        (harmonic ratio and f0) and "formants" (the 4
+                        lowest LPC formant frequencies). The last two are
+                        not computed by default.
+                        Default None: the 34 standard features
+        dtype:          (opt) floating point type of the computation
+                        (np.float64 or np.float32)
     RETURNS
         features (numpy.ndarray):        contains features
                                          (n_feats x numOfShortTermWindows)
@@ -560,126 +1018,198 @@ def feature_extraction(signal, sampling_rate, window, step, deltas=True):
                                          (n_feats x numOfShortTermWindows)
     """
 
-    window = int(window)
-    step = int(step)
-
-    # signal normalization
-    signal = np.double(signal)
-    signal = signal / (2.0 ** 15)
+    features, feature_names = \
+        feature_extraction_batch([signal], sampling_rate, window, step,
+                                 deltas, features, dtype)
+    return features[0], feature_names
 
-    signal = dc_normalize(signal)
 
-    number_of_samples = len(signal)  # total number of samples
-    current_position = 0
-    count_fr = 0
-    num_fft = int(window / 2)
+def feature_extraction_batch(signals, sampling_rate, window, step,
+                             deltas=True, features=None, dtype=np.float64):
+    """
+    Short-term feature extraction for a list of signals that share the same
+    sampling rate. The frames of all signals are packed into one virtual
+    frame matrix that is processed in blocks of FRAME_BLOCK_SIZE frames, so
+    that short signals (e.g. the clips of a training corpus) share the
+    batched FFT passes instead of paying the per-call overhead one by one.
+    Each signal is normalized independently and spectral flux / deltas are
+    reset at signal boundaries, so the results are identical to calling
+    feature_extraction() on each signal.
 
-    # compute the triangular filter banks used in the mfcc calculation
-    fbank, freqs = mfcc_filter_banks(sampling_rate, num_fft)
+    ARGUMENTS
+        signals:        list of signals (np arrays of samples)
+        sampling_rate, window, step, deltas, features, dtype:
+                        see feature_extraction()
+    RETURNS
+        features (list):                 one (n_feats x numOfShortTermWindows)
+                                         matrix per signal (views of a
+                                         single preallocated matrix)
+        feature_names (python list):     contains feature names
+    """
 
-    n_time_spectral_feats = 8
-    n_harmonic_feats = 0
-    n_mfcc_feats = 13
-    n_chroma_feats = 13
-    n_total_feats = n_time_spectral_feats + n_mfcc_feats + n_harmonic_feats + \
-                    n_chroma_feats
-    #    n_total_feats = n_time_spectral_feats + n_mfcc_feats +
-    #    n_harmonic_feats
+    window = int(window)
+    step = int(step)
+    groups = feature_groups(features)
 
     # define list of feature names
-    feature_names = ["zcr", "energy", "energy_entropy"]
-    feature_names += ["spectral_centroid", "spectral_spread"]
-    feature_names.append("spectral_entropy")
-    feature_names.append("spectral_flux")
-    feature_names.append("spectral_rolloff")
-    feature_names += ["mfcc_{0:d}".format(mfcc_i)
-                      for mfcc_i in range(1, n_mfcc_feats + 1)]
-    feature_names += ["chroma_{0:d}".format(chroma_i)
-                      for chroma_i in range(1, n_chroma_feats)]
-    feature_names.append("chroma_std")
+    feature_names = []
+    for g in groups:
+        feature_names += FEATURE_GROUPS[g]
+    n_total_feats = len(feature_names)
 
     # add names for delta features:
     if deltas:
         feature_names_2 = feature_names + ["delta " + f for f in feature_names]
         feature_names = feature_names_2
 
-    features = []
-    # for each short-term window to end of signal
-    while current_position + window - 1 < number_of_samples:
-        count_fr += 1
-        # get current window
-        x = signal[current_position:current_position + window]
-
-        # update window position
-        current_position = current_position + step
-
-        # get fft magnitude
-        fft_magnitude = abs(fft(x))
-
-        # normalize fft
-        fft_magnitude = fft_magnitude[0:num_fft]
-        fft_magnitude = fft_magnitude / len(fft_magnitude)
-
-        # keep previous fft mag (used in spectral flux)
-        if count_fr == 1:
-            fft_magnitude_previous = fft_magnitude.copy()
-        feature_vector = np.zeros((n_total_feats, 1))
-
-        # zero crossing rate
-        feature_vector[0] = zero_crossing_rate(x)
-
-        # short-term energy
-        feature_vector[1] = energy(x)
-
-        # short-term entropy of energy
-        feature_vector[2] = energy_entropy(x)
-
-        # sp centroid/spread
-        [feature_vector[3], feature_vector[4]] = \
-            spectral_centroid_spread(fft_magnitude,
-                                     sampling_rate)
-
-        # spectral entropy
-        feature_vector[5] = \
-            spectral_entropy(fft_magnitude)
-
-        # spectral flux
-        feature_vector[6] = \
-            spectral_flux(fft_magnitude,
-                          fft_magnitude_previous)
-
-        # spectral rolloff
-        feature_vector[7] = \
-            spectral_rolloff(fft_magnitude, 0.90)
-
-        # MFCCs
-        mffc_feats_end = n_time_spectral_feats + n_mfcc_feats
-        feature_vector[n_time_spectral_feats:mffc_feats_end, 0] = \
-            mfcc(fft_magnitude, fbank, n_mfcc_feats).copy()
-
-        # chroma features
-        chroma_names, chroma_feature_matrix = \
-            chroma_features(fft_magnitude, sampling_rate, num_fft)
-        chroma_features_end = n_time_spectral_feats + n_mfcc_feats + \
-                              n_chroma_feats - 1
-        feature_vector[mffc_feats_end:chroma_features_end] = \
-            chroma_feature_matrix
-        feature_vector[chroma_features_end] = chroma_feature_matrix.std()
-        if not deltas:
-            features.append(feature_vector)
-        else:
-            # delta features
-            if count_fr > 1:
-                delta = feature_vector - feature_vector_prev
-                feature_vector_2 = np.concatenate((feature_vector, delta))
-            else:
-                feature_vector_2 = np.concatenate((feature_vector,
-                                                   np.zeros(feature_vector.
-                                                            shape)))
-            feature_vector_prev = feature_vector
-            features.append(feature_vector_2)
-
-        fft_magnitude_previous = fft_magnitude.copy()
-
-    features = np.concatenate(features, 1)
+    frames_list = []
+    for signal in signals:
+        # signal normalization
+        signal = np.asarray(signal, dtype=dtype)
+        signal = signal / (2.0 ** 15)
+        signal = dc_normalize(signal)
+        frames_list.append(frame_matrix(signal, window, step))
+
+    counts = np.array([frames.shape[0] for frames in frames_list], dtype=int)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    n_frames = offsets[-1]
+    all_features = np.zeros((len(feature_names), n_frames), dtype=dtype)
+    starts = offsets[:-1][counts > 0]
+
+    fft_magnitude_previous = None
+    # for each block of the packed short-term windows of all signals
+    for start in range(0, n_frames, FRAME_BLOCK_SIZE):
+        end = min(start + FRAME_BLOCK_SIZE, n_frames)
+        first = np.searchsorted(offsets, start, side="right") - 1
+        last = np.searchsorted(offsets, end, side="left")
+        parts = [frames_list[i][max(start - offsets[i], 0):
+                                min(end, offsets[i + 1]) - offsets[i]]
+                 for i in range(first, last)]
+        frames = parts[0] if len(parts) == 1 else np.concatenate(parts)
+        reset_rows = starts[(starts >= start) & (starts < end)] - start
+        if start in starts:
+            fft_magnitude_previous = None
+        all_features[0:n_total_feats, start:end], fft_magnitude_previous = \
+            frame_features(frames, sampling_rate, groups,
+                           fft_magnitude_previous, reset_rows)
+
+    if deltas and n_frames > 1:
+        # delta features (the delta of the first frame of each signal is 0)
+        all_features[n_total_feats:, 1:] = \
+            np.diff(all_features[0:n_total_feats], axis=1)
+        all_features[n_total_feats:, starts] = 0
+
+    features = [all_features[:, offsets[i]:offsets[i + 1]]
+                for i in range(len(frames_list))]
+
     return features, feature_names
+
+
+class ShortTermFeatureStream:
+    """
+    Incremental (streaming) short-term feature extractor.
+    Raw int16 chunks of any size (e.g. as delivered by a sounddevice
+    callback) are pushed to the stream and the feature vectors of all
+    short-term windows that became complete are returned. The partial-window
+    tail, the previous abs(FFT) (for spectral flux) and the previous feature
+    vector (for deltas) are carried across pushes, so that the stream yields
+    one column per window, exactly like feature_extraction().
+
+    Since the whole signal is not available, dc_normalize() is replaced by a
+    running estimate: the DC is the mean of all samples pushed so far and the
+    amplitude is normalized by the running peak of the DC-free signal. The
+    features of a live stream therefore only converge to those of
+    feature_extraction() once these estimates have settled. If the signal is
+    known in advance (e.g. a file processed in blocks), its
+    normalization_constants() can be passed as normalization=(dc, peak) and
+    the features match those of feature_extraction() for any chunking.
+
+    USAGE EXAMPLE:
+        stream = ShortTermFeatureStream(16000, 320, 160)
+        for chunk in chunks:
+            new_features = stream.push(chunk)   # (n_feats x n_new_windows)
+    """
+
+    def __init__(self, sampling_rate, window, step, deltas=True,
+                 features=None, dtype=np.float64, normalization=None):
+        self.sampling_rate = sampling_rate
+        self.dtype = dtype
+        self.normalization = normalization
+        self.window = int(window)
+        self.step = int(step)
+        self.deltas = deltas
+        self.groups = feature_groups(features)
+
+        self.feature_names = []
+        for g in self.groups:
+            self.feature_names += FEATURE_GROUPS[g]
+        self.n_feats = len(self.feature_names)
+        if deltas:
+            self.feature_names = self.feature_names + \
+                ["delta " + f for f in self.feature_names]
+        self.reset()
+
+    def reset(self):
+        """Clears all carried state (e.g. at the start of a new utterance)"""
+        self.tail = np.zeros((0,), dtype=self.dtype)
+        self.sample_sum = 0.0
+        self.sample_count = 0
+        self.peak = 0.0
+        self.fft_magnitude_previous = None
+        self.feature_vector_previous = None
+        self.n_frames = 0
+        # samples up to the next window start that have not been received
+        # yet (if the step is longer than the window)
+        self.samples_to_skip = 0
+
+    def push(self, chunk):
+        """
+        Appends a chunk of samples to the stream.
+        RETURNS
+            features:   (n_feats x n_new_windows) features of the short-term
+                        windows that were completed by this chunk
+                        (possibly zero columns)
+        """
+        chunk = np.asarray(chunk, dtype=self.dtype).reshape(-1) / (2.0 ** 15)
+
+        # running DC / peak estimates
+        self.sample_sum += chunk.sum()
+        self.sample_count += chunk.shape[0]
+        n_skipped = min(self.samples_to_skip, chunk.shape[0])
+        self.samples_to_skip -= n_skipped
+        self.tail = np.concatenate((self.tail, chunk[n_skipped:]))
+        if self.sample_count == 0:
+            return np.zeros((len(self.feature_names), 0), dtype=self.dtype)
+        if self.normalization is not None:
+            dc, self.peak = self.normalization
+        else:
+            dc = self.sample_sum / self.sample_count
+            if chunk.shape[0] > 0:
+                self.peak = max(self.peak, np.abs(chunk - dc).max())
+
+        frames = frame_matrix(self.tail, self.window, self.step)
+        n_new = frames.shape[0]
+        features = np.zeros((len(self.feature_names), n_new),
+                            dtype=self.dtype)
+        if n_new == 0:
+            return features
+
+        frames = ((frames - dc) / (self.peak + 1e-10)).astype(self.dtype)
+        features[0:self.n_feats], self.fft_magnitude_previous = \
+            frame_features(frames, self.sampling_rate, self.groups,
+                           self.fft_magnitude_previous)
+
+        if self.deltas:
+            if self.feature_vector_previous is None:
+                # the delta of the first frame is zero
+                self.feature_vector_previous = features[0:self.n_feats, 0]
+            features[self.n_feats:] = np.diff(
+                np.column_stack((self.feature_vector_previous,
+                                 features[0:self.n_feats])), axis=1)
+            self.feature_vector_previous = features[0:self.n_feats, -1].copy()
+
+        # keep the samples of the next (incomplete) windows
+        self.samples_to_skip = max(n_new * self.step - self.tail.shape[0], 0)
+        self.tail = self.tail[n_new * self.step:]
+        self.n_frames += n_new
+        return features
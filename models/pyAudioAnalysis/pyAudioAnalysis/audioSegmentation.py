@@ -2,12 +2,14 @@ from __future__ import print_function
 import os
 import csv
 import glob
+import collections
 import scipy
 import sklearn
 import numpy as np
 import hmmlearn.hmm
 import sklearn.cluster
 import pickle as cpickle
+import concurrent.futures
 import matplotlib.pyplot as plt
 from scipy.spatial import distance
 import sklearn.discriminant_analysis
@@ -16,6 +18,7 @@ import sys
 sys.path.insert(0, os.path.join(
     os.path.dirname(os.path.realpath(__file__)), "../"))
 import pyAudioAnalysis.audioBasicIO as audioBasicIO
+import pyAudioAnalysis.utilities as utilities
 import pyAudioAnalysis.audioTrainTest as at
 import pyAudioAnalysis.MidTermFeatures as mtf
 import pyAudioAnalysis.ShortTermFeatures as stf
@@ -74,28 +77,18 @@ def labels_to_segments(labels, window):
         return segs, classes
 
 
-    num_segs = 0
-    index = 0
-    classes = []
-    segment_list = []
-    cur_label = labels[index]
-    while index < len(labels) - 1:
-        previous_value = cur_label
-        while True:
-            index += 1
-            compare_flag = labels[index]
-            if (compare_flag != cur_label) | (index == len(labels) - 1):
-                num_segs += 1
-                cur_label = labels[index]
-                segment_list.append((index * window))
-                classes.append(previous_value)
-                break
-    segments = np.zeros((len(segment_list), 2))
-
-    for i in range(len(segment_list)):
-        if i > 0:
-            segments[i, 0] = segment_list[i-1]
-        segments[i, 1] = segment_list[i]
+    labels_array = np.asarray(labels)
+    # a segment ends at every label change (at the index of its first
+    # different label) and at the last label
+    ends = np.flatnonzero(labels_array[1:] != labels_array[:-1]) + 1
+    if len(ends) == 0 or ends[-1] != len(labels) - 1:
+        ends = np.append(ends, len(labels) - 1)
+    starts = np.concatenate(([0], ends[:-1]))
+    classes = [labels[i] for i in starts]
+
+    segments = np.zeros((len(ends), 2))
+    segments[1:, 0] = ends[:-1] * window
+    segments[:, 1] = ends * window
     return segments, classes
 
 
@@ -112,16 +105,32 @@ def segments_to_labels(start_times, end_times, labels, window):
      - flags:    np array of class indices
      - class_names:    list of classnames (strings)
     """
-    flags = []
     class_names = list(set(labels))
-    index = window / 2.0
-    while index < end_times[-1]:
-        for i in range(len(start_times)):
-            if start_times[i] < index <= end_times[i]:
-                break
-        flags.append(class_names.index(labels[i]))
-        index += window
-    return np.array(flags), class_names
+    start_times = np.asarray(start_times, dtype=np.float64)
+    end_times = np.asarray(end_times, dtype=np.float64)
+    label_ids = np.array([class_names.index(label) for label in labels])
+
+    # window centers (accumulated exactly as window / 2 + window + ...)
+    n_windows = int(np.ceil(end_times[-1] / window)) + 2
+    centers = np.add.accumulate(
+        np.concatenate(([window / 2.0], np.full(n_windows - 1, window))))
+    centers = centers[0:np.searchsorted(centers, end_times[-1], "left")]
+    if len(centers) == 0:
+        return np.array([]), class_names
+
+    # index of the segment of each center (start < center <= end),
+    # the last segment if it is not covered by any segment
+    if np.all(np.diff(start_times) >= 0) and np.all(np.diff(end_times) >= 0):
+        indices = np.searchsorted(end_times, centers, "left")
+        indices = np.minimum(indices, len(end_times) - 1)
+        indices[start_times[indices] >= centers] = len(end_times) - 1
+    else:
+        # unsorted segments: first matching segment of each center
+        inside = (start_times[None, :] < centers[:, None]) & \
+                 (centers[:, None] <= end_times[None, :])
+        indices = np.where(inside.any(axis=1), inside.argmax(axis=1),
+                           len(end_times) - 1)
+    return label_ids[indices], class_names
 
 
 def compute_metrics(confusion_matrix, class_names):
@@ -284,7 +293,76 @@ def evaluate_speaker_diarization(labels, labels_gt):
     return purity_cluster_m, purity_speaker_m
 
 
-def train_hmm_compute_statistics(features, labels):
+# regularization added to the diagonal of full HMM covariance matrices
+# (the default min_covar of hmmlearn)
+HMM_MIN_COVAR = 1e-3
+
+
+def class_moments(features, label_ids, n_comps, covariance_type="diag"):
+    """
+    Computes the per-class sufficient statistics of a sequence of feature
+    vectors in one grouped pass: the feature vectors are sorted by class and
+    the sums of each class are computed with np.add.reduceat
+    ARGUMENTS:
+     - features:         feature matrix (numOfDimensions x n_wins)
+     - label_ids:        class index of each window (0, ..., n_comps - 1)
+     - n_comps:          number of classes
+     - covariance_type:  "diag" or "full"
+    RETURNS:
+     - counts:           number of windows of each class
+     - means:            class means (n_comps x numOfDimensions), nan for
+                         classes without windows
+     - moments:          sums of squared deviations from the class means
+                         (n_comps x numOfDimensions), or of their outer
+                         products if covariance_type is "full"
+                         (n_comps x numOfDimensions x numOfDimensions)
+    """
+    n_feats = features.shape[0]
+    counts = np.bincount(label_ids, minlength=n_comps)
+    order = np.argsort(label_ids, kind="stable")
+    grouped = features[:, order]
+    group_starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    present = counts > 0
+
+    means = np.full((n_comps, n_feats), np.nan)
+    means[present] = (np.add.reduceat(grouped, group_starts[present],
+                                      axis=1) / counts[present]).T
+    deviations = grouped - means[label_ids[order]].T
+
+    if covariance_type == "full":
+        moments = np.full((n_comps, n_feats, n_feats), np.nan)
+        for i in np.flatnonzero(present):
+            dev = deviations[:, group_starts[i]:group_starts[i] + counts[i]]
+            moments[i] = np.dot(dev, dev.T)
+    else:
+        moments = np.full((n_comps, n_feats), np.nan)
+        moments[present] = np.add.reduceat(deviations ** 2,
+                                           group_starts[present], axis=1).T
+    return counts, means, moments
+
+
+def moments_to_covariances(counts, moments, covariance_type="diag"):
+    """
+    Converts the per-class moments of class_moments() to the "cov" output
+    of train_hmm_compute_statistics(): deviations (np.std) for "diag",
+    unbiased covariance matrices (np.cov) plus HMM_MIN_COVAR on the
+    diagonal (so that they are positive definite even for correlated
+    features) for "full". Classes without (enough) windows are nan.
+    """
+    cov = np.full(moments.shape, np.nan)
+    if covariance_type == "full":
+        n_feats = moments.shape[1]
+        for i in np.flatnonzero(counts > 1):
+            cov[i] = moments[i] / (counts[i] - 1) + \
+                HMM_MIN_COVAR * np.eye(n_feats)
+    else:
+        present = counts > 0
+        cov[present] = np.sqrt(moments[present] /
+                               counts[present][:, None])
+    return cov
+
+
+def train_hmm_compute_statistics(features, labels, covariance_type="diag"):
     """
     This function computes the statistics used to train
     an HMM joint segmentation-classification model
@@ -293,58 +371,55 @@ def train_hmm_compute_statistics(features, labels):
     ARGUMENTS:
      - features:  a np matrix of feature vectors (numOfDimensions x n_wins)
      - labels:    a np array of class indices (n_wins x 1)
+     - covariance_type:   (optional) "diag" (per-class deviations) or
+                          "full" (per-class covariance matrices), as in
+                          hmmlearn.hmm.GaussianHMM
     RETURNS:
      - class_priors:            matrix of prior class probabilities
                                 (n_classes x 1)
      - transmutation_matrix:    transition matrix (n_classes x n_classes)
      - means:                   means matrix (numOfDimensions x 1)
-     - cov:                     deviation matrix (numOfDimensions x 1)
+     - cov:                     deviation matrix (numOfDimensions x 1), or
+                                covariance matrices (n_classes x
+                                numOfDimensions x numOfDimensions) if
+                                covariance_type is "full"
     """
+    if covariance_type not in ("diag", "full"):
+        raise ValueError("covariance_type must be \"diag\" or \"full\"")
     unique_labels = np.unique(labels)
     n_comps = len(unique_labels)
 
-    n_feats = features.shape[0]
-
     if features.shape[1] < labels.shape[0]:
         print("trainHMM warning: number of short-term feature vectors "
               "must be greater or equal to the labels length!")
         labels = labels[0:features.shape[1]]
-
-    # compute prior probabilities:
-    class_priors = np.zeros((n_comps,))
-    for i, u_label in enumerate(unique_labels):
-        class_priors[i] = np.count_nonzero(labels == u_label)
-    # normalize prior probabilities
-    class_priors = class_priors / class_priors.sum()
-
-    # compute transition matrix:
-    transmutation_matrix = np.zeros((n_comps, n_comps))
-    for i in range(labels.shape[0]-1):
-        transmutation_matrix[int(labels[i]), int(labels[i + 1])] += 1
-    # normalize rows of transition matrix:
-    for i in range(n_comps):
-        transmutation_matrix[i, :] /= transmutation_matrix[i, :].sum()
-
-    means = np.zeros((n_comps, n_feats))
-    for i in range(n_comps):
-        means[i, :] = \
-            np.array(features[:,
-                     np.nonzero(labels == unique_labels[i])[0]].mean(axis=1))
-
-    cov = np.zeros((n_comps, n_feats))
-    for i in range(n_comps):
-        """
-        cov[i, :, :] = np.cov(features[:, np.nonzero(labels == u_labels[i])[0]])
-        """
-        # use line above if HMM using full gaussian distributions are to be used
-        cov[i, :] = np.std(features[:,
-                           np.nonzero(labels == unique_labels[i])[0]],
-                           axis=1)
+    # (position of each label in unique_labels)
+    label_ids = np.searchsorted(unique_labels, labels)
+
+    # compute means and deviations (or covariances) of each class:
+    counts, means, moments = class_moments(features, label_ids, n_comps,
+                                           covariance_type)
+    cov = moments_to_covariances(counts, moments, covariance_type)
+
+    # compute (normalized) prior probabilities:
+    class_priors = counts / counts.sum()
+
+    # compute transition matrix (count all pairs of consecutive labels):
+    transmutation_matrix = np.bincount(
+        label_ids[:-1] * n_comps + label_ids[1:],
+        minlength=n_comps * n_comps).reshape(n_comps, n_comps).astype(float)
+    # normalize rows of transition matrix (uniform rows for the classes
+    # that are never followed by another window, see HMMStatistics):
+    row_sums = transmutation_matrix.sum(axis=1, keepdims=True)
+    transmutation_matrix = np.where(
+        row_sums > 0, transmutation_matrix / np.maximum(row_sums, 1),
+        1.0 / n_comps)
 
     return class_priors, transmutation_matrix, means, cov
 
 
-def train_hmm_from_file(wav_file, gt_file, hmm_model_name, mid_window, mid_step):
+def train_hmm_from_file(wav_file, gt_file, hmm_model_name, mid_window, mid_step,
+                        covariance_type="diag"):
     """
     This function trains a HMM model for segmentation-classification
     using a single annotated audio file
@@ -356,6 +431,7 @@ def train_hmm_from_file(wav_file, gt_file, hmm_model_name, mid_window, mid_step)
      - hmm_model_name:   the name of the HMM model to be stored
      - mt_win:          mid-term window size
      - mt_step:         mid-term window step
+     - covariance_type: (optional) "diag" or "full" gaussian emissions
     RETURNS:
      - hmm:            an object to the resulting HMM
      - class_names:     a list of class_names
@@ -374,11 +450,12 @@ def train_hmm_from_file(wav_file, gt_file, hmm_model_name, mid_window, mid_step)
                                    round(sampling_rate * 0.050),
                                    round(sampling_rate * 0.050))
     class_priors, transumation_matrix, means, cov = \
-        train_hmm_compute_statistics(features, flags)
-    hmm = hmmlearn.hmm.GaussianHMM(class_priors.shape[0], "diag")
+        train_hmm_compute_statistics(features, flags, covariance_type)
+    hmm = hmmlearn.hmm.GaussianHMM(class_priors.shape[0], covariance_type)
 
-    hmm.covars_ = cov
+    # (means_ first: hmmlearn infers the number of features from them)
     hmm.means_ = means
+    hmm.covars_ = cov
     hmm.startprob_ = class_priors
     hmm.transmat_ = transumation_matrix
 
@@ -387,7 +464,139 @@ def train_hmm_from_file(wav_file, gt_file, hmm_model_name, mid_window, mid_step)
     return hmm, class_names
 
 
-def train_hmm_from_directory(folder_path, hmm_model_name, mid_window, mid_step):
+class HMMStatistics:
+    """
+    Sufficient statistics of an HMM segmentation-classification model
+    (per-class window counts, means and moments of the feature vectors and
+    counts of the class transitions), accumulated file by file without
+    storing the feature vectors. Statistics of different files (e.g.
+    computed in parallel) are combined with merge(), using the pairwise
+    update of means and moments (Chan et al.), so the result does not
+    depend on how the files are grouped.
+    """
+
+    def __init__(self, covariance_type="diag"):
+        self.covariance_type = covariance_type
+        # classes in order of first appearance
+        self.class_names = []
+        self.counts = {}
+        self.means = {}
+        self.moments = {}
+        # (class name, next class name) -> number of transitions
+        self.transitions = {}
+
+    def add(self, features, flags, class_names):
+        """
+        Adds the windows of one labelled sequence
+        ARGUMENTS:
+         - features:      feature matrix (numOfDimensions x n_wins)
+         - flags:         class index of each window (in class_names), as
+                          returned by segments_to_labels()
+         - class_names:   the class names of the flags
+        """
+        n_wins = min(features.shape[1], len(flags))
+        flags = np.asarray(flags[0:n_wins], dtype=int)
+        # classes of this sequence, in order of first appearance
+        used, first = np.unique(flags, return_index=True)
+        used = used[np.argsort(first)]
+        names = [class_names[f] for f in used]
+        local_ids = np.zeros(len(class_names), dtype=int)
+        local_ids[used] = np.arange(len(used))
+        flags = local_ids[flags]
+
+        other = HMMStatistics(self.covariance_type)
+        other.class_names = names
+        counts, means, moments = class_moments(features[:, 0:n_wins], flags,
+                                               len(names),
+                                               self.covariance_type)
+        pairs = np.bincount(flags[:-1] * len(names) + flags[1:],
+                            minlength=len(names) ** 2)
+        for i, name in enumerate(names):
+            other.counts[name] = counts[i]
+            other.means[name] = means[i]
+            other.moments[name] = moments[i]
+        for pair in np.flatnonzero(pairs):
+            other.transitions[(names[pair // len(names)],
+                               names[pair % len(names)])] = pairs[pair]
+        self.merge(other)
+
+    def merge(self, other):
+        """Adds the statistics of another HMMStatistics object"""
+        for name in other.class_names:
+            n_b = other.counts[name]
+            if name not in self.counts:
+                self.class_names.append(name)
+                self.counts[name] = n_b
+                self.means[name] = other.means[name]
+                self.moments[name] = other.moments[name]
+                continue
+            n_a = self.counts[name]
+            n = n_a + n_b
+            delta = other.means[name] - self.means[name]
+            if self.covariance_type == "full":
+                correction = np.outer(delta, delta)
+            else:
+                correction = delta ** 2
+            self.means[name] = self.means[name] + delta * n_b / n
+            self.moments[name] = self.moments[name] + other.moments[name] + \
+                correction * n_a * n_b / n
+            self.counts[name] = n
+        for pair, count in other.transitions.items():
+            self.transitions[pair] = self.transitions.get(pair, 0) + count
+        return self
+
+    def parameters(self):
+        """
+        Returns the HMM parameters (same outputs as
+        train_hmm_compute_statistics(), in the order of class_names).
+        Transitions are only counted within each sequence, and the
+        transition probabilities of a class that is never followed by
+        another window are uniform.
+        """
+        n_comps = len(self.class_names)
+        counts = np.array([self.counts[c] for c in self.class_names])
+        class_priors = counts / counts.sum()
+        index = {c: i for i, c in enumerate(self.class_names)}
+        transmutation_matrix = np.zeros((n_comps, n_comps))
+        for (c1, c2), count in self.transitions.items():
+            transmutation_matrix[index[c1], index[c2]] = count
+        row_sums = transmutation_matrix.sum(axis=1, keepdims=True)
+        transmutation_matrix = np.where(
+            row_sums > 0, transmutation_matrix / np.maximum(row_sums, 1),
+            1.0 / n_comps)
+        means = np.array([self.means[c] for c in self.class_names])
+        cov = moments_to_covariances(
+            counts, np.array([self.moments[c] for c in self.class_names]),
+            self.covariance_type)
+        return class_priors, transmutation_matrix, means, cov
+
+
+def hmm_batch_statistics(wav_files, mid_window, mid_step,
+                         covariance_type="diag"):
+    """
+    Computes the HMMStatistics of a batch of annotated WAV files (the
+    ground truth of each file is stored in a .segments file, see
+    train_hmm_from_directory()) without keeping their feature vectors
+    """
+    statistics = HMMStatistics(covariance_type)
+    for wav_file in wav_files:
+        gt_file = wav_file.replace('.wav', '.segments')
+        seg_start, seg_end, seg_labs = read_segmentation_gt(gt_file)
+        flags, class_names = \
+            segments_to_labels(seg_start, seg_end, seg_labs, mid_step)
+        sampling_rate, signal = audioBasicIO.read_audio_file(wav_file)
+        feature_vector, _, _ = \
+            mtf.mid_feature_extraction(signal, sampling_rate,
+                                       mid_window * sampling_rate,
+                                       mid_step * sampling_rate,
+                                       round(sampling_rate * 0.050),
+                                       round(sampling_rate * 0.050))
+        statistics.add(feature_vector, flags, class_names)
+    return statistics
+
+
+def train_hmm_from_directory(folder_path, hmm_model_name, mid_window, mid_step,
+                             covariance_type="diag", n_jobs=1):
     """
     This function trains a HMM model for segmentation-classification using
     a where WAV files and .segment (ground-truth files) are stored
@@ -396,61 +605,36 @@ def train_hmm_from_directory(folder_path, hmm_model_name, mid_window, mid_step):
      - hmm_model_name:  the name of the HMM model to be stored
      - mt_win:          mid-term window size
      - mt_step:         mid-term window step
+     - covariance_type: (optional) "diag" or "full" gaussian emissions
+     - n_jobs:          (optional) number of worker processes (see
+                        utilities.effective_n_jobs)
     RETURNS:
      - hmm:            an object to the resulting HMM
      - class_names:    a list of class_names
 
     After training, hmm, class_names, along with the mt_win
-    and mt_step values are stored in the hmm_model_name file
+    and mt_step values are stored in the hmm_model_name file.
+    The files are processed in batches (in parallel if n_jobs > 1) and
+    only the sufficient statistics of each batch (see HMMStatistics) are
+    kept, so the memory does not grow with the size of the corpus.
     """
 
-    flags_all = np.array([])
-    class_names_all = []
-    for i, f in enumerate(glob.glob(folder_path + os.sep + '*.wav')):
-        # for each WAV file
-        wav_file = f
-        gt_file = f.replace('.wav', '.segments')
-        if os.path.isfile(gt_file):
-            seg_start, seg_end, seg_labs = read_segmentation_gt(gt_file)
-            flags, class_names = \
-                segments_to_labels(seg_start, seg_end, seg_labs, mid_step)
-            for c in class_names:
-                # update class names:
-                if c not in class_names_all:
-                    class_names_all.append(c)
-            sampling_rate, signal = audioBasicIO.read_audio_file(wav_file)
-            feature_vector, _, _ = \
-                mtf.mid_feature_extraction(signal, sampling_rate,
-                                           mid_window * sampling_rate,
-                                           mid_step * sampling_rate,
-                                           round(sampling_rate * 0.050),
-                                           round(sampling_rate * 0.050))
-
-            flag_len = len(flags)
-            feat_cols = feature_vector.shape[1]
-            min_sm = min(feat_cols, flag_len)
-            feature_vector = feature_vector[:, 0:min_sm]
-            flags = flags[0:min_sm]
-
-            flags_new = []
-            # append features and labels
-            for j, fl in enumerate(flags):
-                flags_new.append(class_names_all.index(class_names_all[flags[j]]))
-
-            flags_all = np.append(flags_all, np.array(flags_new))
-
-            if i == 0:
-                f_all = feature_vector
-            else:
-                f_all = np.concatenate((f_all, feature_vector), axis=1)
+    wav_files = [f for f in glob.glob(folder_path + os.sep + '*.wav')
+                 if os.path.isfile(f.replace('.wav', '.segments'))]
+    statistics = HMMStatistics(covariance_type)
+    for batch_statistics in mtf.map_file_batches(
+            hmm_batch_statistics, wav_files, n_jobs, mid_window, mid_step,
+            covariance_type):
+        statistics.merge(batch_statistics)
+    class_names_all = statistics.class_names
 
     # compute HMM statistics
-    class_priors, transmutation_matrix, means, cov = \
-        train_hmm_compute_statistics(f_all, flags_all)
+    class_priors, transmutation_matrix, means, cov = statistics.parameters()
     # train the HMM
-    hmm = hmmlearn.hmm.GaussianHMM(class_priors.shape[0], "diag")
-    hmm.covars_ = cov
+    hmm = hmmlearn.hmm.GaussianHMM(class_priors.shape[0], covariance_type)
+    # (means_ first: hmmlearn infers the number of features from them)
     hmm.means_ = means
+    hmm.covars_ = cov
     hmm.startprob_ = class_priors
     hmm.transmat_ = transmutation_matrix
 
@@ -468,25 +652,198 @@ def save_hmm(hmm_model_name, model, classes, mid_window, mid_step):
         cpickle.dump(mid_step, f_handle, protocol=cpickle.HIGHEST_PROTOCOL)
 
 
-def hmm_segmentation(audio_file, hmm_model_name, plot_results=False,
-                     gt_file=""):
-    sampling_rate, signal = audioBasicIO.read_audio_file(audio_file)
-
+def load_hmm(hmm_model_name):
+    """Load HMM model (see save_hmm)"""
     with open(hmm_model_name, "rb") as f_handle:
         hmm = cpickle.load(f_handle)
         class_names = cpickle.load(f_handle)
         mid_window = cpickle.load(f_handle)
         mid_step = cpickle.load(f_handle)
+    return hmm, class_names, mid_window, mid_step
 
-    features, _, _ = \
-        mtf.mid_feature_extraction(signal, sampling_rate,
-                                   mid_window * sampling_rate,
-                                   mid_step * sampling_rate,
-                                   round(sampling_rate * 0.050),
-                                   round(sampling_rate * 0.050))
 
-    # apply model
-    labels = hmm.predict(features.T)
+class FixedLagViterbi:
+    """
+    Online (fixed-lag) Viterbi decoding of a trained hmmlearn HMM.
+    Observations are pushed in blocks and the label of each window is
+    finalized as soon as `lag` more windows have been observed: it is the
+    state of the best path ending at the newest window, traced back `lag`
+    steps. Only the current path scores and the backpointers of the last
+    `lag` windows are kept, so memory does not depend on the length of the
+    sequence. If the sequence is not longer than `lag`, flush() returns the
+    exact Viterbi path (as hmm.predict()); for shorter lags the labels may
+    differ where the best path is still ambiguous after `lag` windows.
+
+    USAGE EXAMPLE:
+        decoder = FixedLagViterbi(hmm, lag=50)
+        for block in feature_blocks:            # (n_feats x n_windows)
+            labels = decoder.push(block)
+        labels = decoder.flush()
+    """
+
+    def __init__(self, hmm, lag):
+        self.hmm = hmm
+        self.lag = int(lag)
+        with np.errstate(divide="ignore"):
+            self.log_startprob = np.log(hmm.startprob_)
+            self.log_transmat = np.log(hmm.transmat_)
+        self.reset()
+
+    def reset(self):
+        """Clears the decoding state (e.g. at the start of a new recording)"""
+        self.log_delta = None
+        self.backpointers = collections.deque(maxlen=self.lag)
+        self.n_pending = 0
+        self.n_windows = 0
+
+    def backtrack(self, n_steps):
+        """
+        Traces the best path that ends at the newest window back n_steps
+        windows (n_steps <= number of stored backpointers)
+        RETURNS
+            path:   (n_steps + 1) states, oldest first
+        """
+        path = np.zeros((n_steps + 1,), dtype=int)
+        path[-1] = np.argmax(self.log_delta)
+        for i in range(n_steps):
+            path[-2 - i] = self.backpointers[-1 - i][path[-1 - i]]
+        return path
+
+    def push(self, features):
+        """
+        Appends a block of observations.
+        ARGUMENTS:
+            - features:     (n_feats x n_windows) observations (mid-term
+                            feature vectors, as passed to hmm.predict())
+        RETURNS:
+            - labels:       the labels that were finalized by this block
+                            (possibly empty)
+        """
+        labels = []
+        if features.shape[1] == 0:
+            return np.array(labels, dtype=int)
+        log_likelihood = self.hmm._compute_log_likelihood(features.T)
+        for frame_log_likelihood in log_likelihood:
+            if self.log_delta is None:
+                self.log_delta = self.log_startprob + frame_log_likelihood
+            else:
+                scores = self.log_delta[:, np.newaxis] + self.log_transmat
+                pointers = np.argmax(scores, axis=0)
+                self.log_delta = scores[pointers,
+                                        np.arange(len(pointers))] + \
+                    frame_log_likelihood
+                self.backpointers.append(pointers)
+            # only the differences of the path scores matter
+            self.log_delta = self.log_delta - np.max(self.log_delta)
+            self.n_pending += 1
+            self.n_windows += 1
+            if self.n_pending > self.lag:
+                labels.append(self.backtrack(self.lag)[0])
+                self.n_pending -= 1
+        return np.array(labels, dtype=int)
+
+    def flush(self):
+        """
+        Ends the sequence.
+        RETURNS:
+            - labels:       the (best path) labels of the remaining windows
+        """
+        if self.n_pending == 0:
+            return np.zeros((0,), dtype=int)
+        labels = self.backtrack(self.n_pending - 1)
+        self.n_pending = 0
+        return labels
+
+
+class HMMSegmentationStream:
+    """
+    Streaming HMM segmentation: raw int16 chunks are pushed to a
+    MidTermFeatureStream and the mid-term feature vectors are decoded with
+    a FixedLagViterbi. Labels are returned with a fixed delay of `lag`
+    seconds and memory stays constant, regardless of the recording length.
+    The HMM is trained on mid_feature_extraction() features, which are
+    normalized with the DC and peak of the whole signal: the features of a
+    live stream use running estimates instead (see MidTermFeatureStream)
+    and only converge to them once these estimates have settled, unless
+    normalization=(dc, peak) is given (see
+    ShortTermFeatures.normalization_constants()).
+
+    USAGE EXAMPLE:
+        stream = HMMSegmentationStream("hmm_model", 16000, lag=5.0)
+        for chunk in chunks:
+            labels = stream.push(chunk)
+        labels = stream.flush()
+    """
+
+    def __init__(self, hmm_model_name, sampling_rate, lag=5.0,
+                 normalization=None):
+        self.hmm, self.class_names, self.mid_window, self.mid_step = \
+            load_hmm(hmm_model_name)
+        self.sampling_rate = sampling_rate
+        self.features = mtf.MidTermFeatureStream(
+            sampling_rate, self.mid_window * sampling_rate,
+            self.mid_step * sampling_rate, round(sampling_rate * 0.050),
+            round(sampling_rate * 0.050), normalization=normalization)
+        self.decoder = FixedLagViterbi(self.hmm,
+                                       int(np.ceil(lag / self.mid_step)))
+
+    def reset(self):
+        """Clears all carried state (e.g. at the start of a new recording)"""
+        self.features.reset()
+        self.decoder.reset()
+
+    def push(self, chunk):
+        """
+        Appends a chunk of samples to the stream.
+        RETURNS
+            labels:     the finalized labels (one per mid-term step)
+        """
+        return self.decoder.push(self.features.push(chunk))
+
+    def flush(self):
+        """
+        Ends the stream.
+        RETURNS
+            labels:     the labels of the remaining mid-term windows
+        """
+        labels = self.decoder.push(self.features.flush())
+        return np.concatenate((labels, self.decoder.flush()))
+
+
+def hmm_segmentation(audio_file, hmm_model_name, plot_results=False,
+                     gt_file="", lag=None, block_size=60.0):
+    """
+    HMM segmentation of an audio file.
+    If lag (in seconds) is given, the file is processed in blocks of
+    block_size seconds through a HMMSegmentationStream (fixed-lag Viterbi),
+    so that the features and the decoding need constant memory for
+    arbitrarily long recordings. The blocks are normalized with the DC and
+    peak of the whole signal, so the features are those of the default
+    path and a lag longer than the recording gives the same labels.
+    """
+    sampling_rate, signal = audioBasicIO.read_audio_file(audio_file)
+
+    if lag is None:
+        hmm, class_names, mid_window, mid_step = load_hmm(hmm_model_name)
+        features, _, _ = \
+            mtf.mid_feature_extraction(signal, sampling_rate,
+                                       mid_window * sampling_rate,
+                                       mid_step * sampling_rate,
+                                       round(sampling_rate * 0.050),
+                                       round(sampling_rate * 0.050))
+
+        # apply model
+        labels = hmm.predict(features.T)
+    else:
+        signal = audioBasicIO.stereo_to_mono(signal)
+        stream = HMMSegmentationStream(
+            hmm_model_name, sampling_rate, lag,
+            normalization=stf.normalization_constants(signal))
+        class_names, mid_step = stream.class_names, stream.mid_step
+        block = max(int(block_size * sampling_rate), 1)
+        labels = [stream.push(signal[i:i + block])
+                  for i in range(0, len(signal), block)]
+        labels = np.concatenate(labels + [stream.flush()])
     labels_gt, class_names_gt, accuracy, cm = \
         load_ground_truth(gt_file, labels, class_names, mid_step, plot_results)
     return labels, class_names, accuracy, cm
@@ -678,8 +1035,46 @@ def evaluate_segmentation_classification_dir(dir_name, model_name, method_name):
         print("Confusion matrix was empty, accuracy for every file was 0")
 
 
+def training_frames(indices, max_frames=None):
+    """
+    Returns (at most) max_frames evenly spaced elements of a sorted array of
+    frame indices (all of them if max_frames is None)
+    """
+    if max_frames is None or len(indices) <= max_frames:
+        return indices
+    return indices[np.linspace(0, len(indices) - 1, int(max_frames)).
+                   round().astype(int)]
+
+
+def energy_frame_sets(st_energy):
+    """
+    Splits the short-term frames of a signal to low and high energy ones
+    (used as the silence / onset examples of the VAD classifiers)
+    ARGUMENTS:
+     - st_energy:      the short-term energy sequence
+    RETURNS:
+     - low_indices:    indices of the frames whose energy is below the mean
+                       energy of the lower 10% of the frames
+     - high_indices:   indices of the frames whose energy is above the mean
+                       energy of the higher 10% of the frames
+    """
+    en = np.sort(st_energy)
+    # number of 10% of the total short-term windows
+    st_windows_fraction = int(len(en) / 10)
+
+    # compute "lower" 10% energy threshold
+    low_threshold = np.mean(en[0:st_windows_fraction]) + 1e-15
+
+    # compute "higher" 10% energy threshold
+    high_threshold = np.mean(en[-st_windows_fraction:-1]) + 1e-15
+
+    return np.where(st_energy <= low_threshold)[0], \
+        np.where(st_energy >= high_threshold)[0]
+
+
 def silence_removal(signal, sampling_rate, st_win, st_step, smooth_window=0.5,
-                    weight=0.5, plot=False):
+                    weight=0.5, plot=False, features=None,
+                    max_train_frames=1000, model=None):
     """
     Event Detection (silence removal)
     ARGUMENTS:
@@ -690,6 +1085,20 @@ def silence_removal(signal, sampling_rate, st_win, st_step, smooth_window=0.5,
          - weight:           (optinal) weight factor (0 < weight < 1)
                               the higher, the more strict
          - plot:             (optinal) True if results are to be plotted
+         - features:         (optional) short-term feature groups used by
+                              the onset classifier (see
+                              ShortTermFeatures.feature_groups), e.g.
+                              ["time", "spectral"] for a faster VAD.
+                              Default: all features
+         - max_train_frames: (optional) maximum number of low (resp. high)
+                              energy frames used to train the onset
+                              classifier (an evenly spaced subsample is
+                              used for long signals). None: all frames
+         - model:            (optional) a pretrained VADModel (or the path
+                              of a stored one, see train_vad_model()), used
+                              instead of training a new classifier on the
+                              signal. Its st_win, st_step and features
+                              override the respective arguments
     RETURNS:
          - seg_limits:    list of segment limits in seconds (e.g [[0.1, 0.9],
                           [1.4, 3.0]] means that
@@ -702,93 +1111,86 @@ def silence_removal(signal, sampling_rate, st_win, st_step, smooth_window=0.5,
     if weight <= 0:
         weight = 0.01
 
+    if isinstance(model, str):
+        model = load_vad_model(model)
+    if model is not None:
+        st_win, st_step, features = model.st_win, model.st_step, \
+            model.features
+
     # Step 1: feature extraction
     signal = audioBasicIO.stereo_to_mono(signal)
-    st_feats, _ = stf.feature_extraction(signal, sampling_rate,
-                                         st_win * sampling_rate,
-                                         st_step * sampling_rate)
-
-    # Step 2: train binary svm classifier of low vs high energy frames
-    # keep only the energy short-term sequence (2nd feature)
-    st_energy = st_feats[1, :]
-    en = np.sort(st_energy)
-    # number of 10% of the total short-term windows
-    st_windows_fraction = int(len(en) / 10)
-
-    # compute "lower" 10% energy threshold
-    low_threshold = np.mean(en[0:st_windows_fraction]) + 1e-15
-
-    # compute "higher" 10% energy threshold
-    high_threshold = np.mean(en[-st_windows_fraction:-1]) + 1e-15
-
-    # get all features that correspond to low energy
-    low_energy = st_feats[:, np.where(st_energy <= low_threshold)[0]]
+    features = vad_feature_groups(features)
+    st_feats, st_feat_names = stf.feature_extraction(signal, sampling_rate,
+                                                     st_win * sampling_rate,
+                                                     st_step * sampling_rate,
+                                                     features=features)
+
+    if model is not None:
+        # Step 2: use the pretrained (onset vs silence) model, adapted to
+        # the background of this signal
+        prob_on_set = model.onset_probability(st_feats, st_feat_names)
+    else:
+        # Step 2: train binary svm classifier of low vs high energy frames
+        low_indices, high_indices = energy_frame_sets(
+            st_feats[st_feat_names.index("energy"), :])
 
-    # get all features that correspond to high energy
-    high_energy = st_feats[:, np.where(st_energy >= high_threshold)[0]]
+        # get all features that correspond to low energy
+        low_energy = st_feats[:, training_frames(low_indices,
+                                                 max_train_frames)]
 
-    # form the binary classification task and ...
-    features = [low_energy.T, high_energy.T]
-    # normalize and train the respective svm probabilistic model
+        # get all features that correspond to high energy
+        high_energy = st_feats[:, training_frames(high_indices,
+                                                  max_train_frames)]
 
-    # (ONSET vs SILENCE)
-    features, labels = at.features_to_matrix(features)
-    scaler = StandardScaler()
-    features_norm = scaler.fit_transform(features)
-    mean = scaler.mean_
-    std = scaler.scale_
-    svm = at.train_svm(features_norm, labels, 1.0)
+        # form the binary classification task and ...
+        features = [low_energy.T, high_energy.T]
+        # normalize and train the respective svm probabilistic model
 
-    # Step 3: compute onset probability based on the trained svm
-    prob_on_set = []
-    for index in range(st_feats.shape[1]):
-        # for each frame
-        cur_fv = (st_feats[:, index] - mean) / std
+        # (ONSET vs SILENCE)
+        features, labels = at.features_to_matrix(features)
+        scaler = StandardScaler()
+        features_norm = scaler.fit_transform(features)
+        mean = scaler.mean_
+        std = scaler.scale_
+        svm = at.train_svm(features_norm, labels, 1.0)
+
+        # Step 3: compute onset probability based on the trained svm
+        # (all frames are normalized and scored in one call)
+        st_feats_norm = (st_feats.T - mean) / std
         # get svm probability (that it belongs to the ONSET class)
-        prob_on_set.append(svm.predict_proba(cur_fv.reshape(1, -1))[0][1])
-    prob_on_set = np.array(prob_on_set)
+        prob_on_set = svm.predict_proba(st_feats_norm)[:, 1]
 
     # smooth probability:
     prob_on_set = smooth_moving_avg(prob_on_set, smooth_window / st_step)
 
     # Step 4A: detect onset frame indices:
-    prog_on_set_sort = np.sort(prob_on_set)
-
     # find probability Threshold as a weighted average
-    # of top 10% and lower 10% of the values
-    nt = int(prog_on_set_sort.shape[0] / 10)
+    # of top 10% and lower 10% of the values (a partial sort is enough to
+    # select them)
+    n_frames = prob_on_set.shape[0]
+    nt = int(n_frames / 10)
+    prog_on_set_sort = np.partition(prob_on_set, [nt, n_frames - nt - 1])
     threshold = (np.mean((1 - weight) * prog_on_set_sort[0:nt]) +
-         weight * np.mean(prog_on_set_sort[-nt::]))
+         weight * np.mean(prog_on_set_sort[n_frames - nt:]))
 
     max_indices = np.where(prob_on_set > threshold)[0]
     # get the indices of the frames that satisfy the thresholding
-    index = 0
-    seg_limits = []
-    time_clusters = []
-
-    # Step 4B: group frame indices to onset segments
-    while index < len(max_indices):
-        # for each of the detected onset indices
-        cur_cluster = [max_indices[index]]
-        if index == len(max_indices)-1:
-            break
-        while max_indices[index+1] - cur_cluster[-1] <= 2:
-            cur_cluster.append(max_indices[index+1])
-            index += 1
-            if index == len(max_indices)-1:
-                break
-        index += 1
-        time_clusters.append(cur_cluster)
-        seg_limits.append([cur_cluster[0] * st_step,
-                           cur_cluster[-1] * st_step])
+
+    # Step 4B: group frame indices to onset segments (indices that are at
+    # most 2 frames apart belong to the same segment)
+    cluster_starts = cluster_ends = np.zeros((0,))
+    if len(max_indices) > 0:
+        breaks = np.flatnonzero(np.diff(max_indices) > 2)
+        cluster_starts = max_indices[np.concatenate(([0], breaks + 1))] * \
+            st_step
+        cluster_ends = max_indices[np.concatenate((breaks, [-1]))] * st_step
 
     # Step 5: Post process: remove very small segments:
     min_duration = 0.2
-    seg_limits_2 = []
-    for s_lim in seg_limits:
-        if s_lim[1] - s_lim[0] > min_duration:
-            seg_limits_2.append(s_lim)
-    seg_limits = seg_limits_2
+    long_segments = cluster_ends - cluster_starts > min_duration
+    seg_limits = [[s_start, s_end] for s_start, s_end in
+                  zip(cluster_starts[long_segments],
+                      cluster_ends[long_segments])]
 
     if plot:
         time_x = np.arange(0, signal.shape[0] / float(sampling_rate), 1.0 /
@@ -812,8 +1214,510 @@ def silence_removal(signal, sampling_rate, st_win, st_step, smooth_window=0.5,
     return seg_limits
 
 
+def vad_feature_groups(features=None):
+    """
+    Returns the short-term feature groups used by the VAD classifiers (the
+    energy feature, i.e. the "time" group, is always needed)
+    """
+    features = stf.feature_groups(features)
+    if "time" not in features:
+        features = ["time"] + features
+    return features
+
+
+class VADModel:
+    """
+    Pretrained onset vs silence classifier (see train_vad_model()), that
+    can be reused by silence_removal() for any number of signals instead of
+    training a new SVM on each one.
+
+    The classifier operates on short-term features relative to the
+    background, i.e. the mean feature vector of the low energy frames of
+    the signal. The background estimate is adapted online: each analyzed
+    signal moves it towards its own background by a factor adaptation
+    (1: only the current signal is used, 0: the training background is
+    kept), so that consecutive recordings of the same session share a
+    smoothed noise floor.
+    """
+
+    def __init__(self, svm, mean, std, background, st_win, st_step,
+                 features, adaptation=0.5):
+        self.svm = svm
+        self.mean = mean
+        self.std = std
+        self.background = background
+        self.st_win = st_win
+        self.st_step = st_step
+        self.features = features
+        self.adaptation = adaptation
+
+    def adapt(self, st_feats, st_feat_names):
+        """
+        Updates (and returns) the background estimate with the low energy
+        frames of a short-term feature matrix
+        """
+        low_indices, _ = energy_frame_sets(
+            st_feats[st_feat_names.index("energy"), :])
+        if len(low_indices) > 0:
+            background = st_feats[:, low_indices].mean(axis=1)
+            self.background = self.background + self.adaptation * \
+                (background - self.background)
+        return self.background
+
+    def onset_probability(self, st_feats, st_feat_names, adapt=True):
+        """
+        Returns the onset (speech) probability of each column of a
+        short-term feature matrix (first adapting the background to it,
+        unless adapt is False)
+        """
+        if adapt:
+            self.adapt(st_feats, st_feat_names)
+        st_feats_norm = (st_feats.T - self.background - self.mean) / self.std
+        return self.svm.predict_proba(st_feats_norm)[:, 1]
+
+    def save(self, model_name):
+        """Stores the model (see load_vad_model())"""
+        with open(model_name, "wb") as f_handle:
+            cpickle.dump(self, f_handle, protocol=cpickle.HIGHEST_PROTOCOL)
+
+
+def train_vad_model(signals, sampling_rate, st_win=0.02, st_step=0.02,
+                    features=None, max_train_frames=1000, model_name=None):
+    """
+    Trains a reusable onset vs silence model (see VADModel), using the low
+    and high energy frames of a set of signals (the same examples that
+    silence_removal() uses for a single signal).
+    ARGUMENTS:
+     - signals:             list of audio signals (or a single signal,
+                            mono or stereo)
+     - sampling_rate:       sampling freq
+     - st_win, st_step:     window size and step in seconds
+     - features:            (optional) short-term feature groups
+     - max_train_frames:    (optional) maximum number of low (resp. high)
+                            energy training frames per signal
+     - model_name:          (optional) path to store the model
+    RETURNS:
+     - model:               the trained VADModel
+    """
+    if isinstance(signals, np.ndarray):
+        signals = [signals]
+    features = vad_feature_groups(features)
+    signals = [audioBasicIO.stereo_to_mono(signal) for signal in signals]
+    st_feats_list, st_feat_names = stf.feature_extraction_batch(
+        signals, sampling_rate, st_win * sampling_rate,
+        st_step * sampling_rate, features=features)
+
+    low_energy, high_energy, backgrounds = [], [], []
+    for st_feats in st_feats_list:
+        low_indices, high_indices = energy_frame_sets(
+            st_feats[st_feat_names.index("energy"), :])
+        if len(low_indices) == 0 or len(high_indices) == 0:
+            continue
+        background = st_feats[:, low_indices].mean(axis=1)
+        backgrounds.append(background)
+        low_energy.append(st_feats[:, training_frames(
+            low_indices, max_train_frames)].T - background)
+        high_energy.append(st_feats[:, training_frames(
+            high_indices, max_train_frames)].T - background)
+    if len(backgrounds) == 0:
+        raise ValueError("No training signal is long enough to train "
+                         "a VAD model")
+
+    # (ONSET vs SILENCE)
+    train_features, labels = at.features_to_matrix(
+        [np.concatenate(low_energy), np.concatenate(high_energy)])
+    scaler = StandardScaler()
+    features_norm = scaler.fit_transform(train_features)
+    svm = at.train_svm(features_norm, labels, 1.0)
+
+    model = VADModel(svm, scaler.mean_, scaler.scale_,
+                     np.mean(backgrounds, axis=0), st_win, st_step, features)
+    if model_name is not None:
+        model.save(model_name)
+    return model
+
+
+# VAD models loaded in this process (path -> VADModel), see load_vad_model()
+vad_models = {}
+
+
+def load_vad_model(model_name):
+    """
+    Loads a model stored by train_vad_model(). Each path is read only once
+    per process: the same (adapting) VADModel instance is returned to all
+    callers.
+    """
+    path = os.path.abspath(model_name)
+    if path not in vad_models:
+        with open(path, "rb") as f_handle:
+            vad_models[path] = cpickle.load(f_handle)
+    return vad_models[path]
+
+
+class StreamingVAD:
+    """
+    Streaming (real-time) voice activity detector.
+    Raw int16 chunks of any size (e.g. as delivered by a sounddevice
+    callback) are pushed to the detector, which splits them in short-term
+    frames and returns the speech "start" / "end" events that were decided
+    by the new frames. Unlike silence_removal() no classifier is trained:
+    each frame is compared to an adaptive estimate of the background, i.e.
+    the noise floor of the frame energy (in dB) and the mean spectral
+    entropy of the non-speech frames. A frame is voiced if its energy is
+    energy_margin dB above the noise floor and its spectrum is more
+    structured (lower entropy) than the background, or if it is
+    2 * energy_margin dB above the floor.
+
+    The background is initialized from the first warmup seconds: the noise
+    floor is a low (10th) percentile of their energies, capped at
+    initial_floor dB, so that speech that starts with the recording is
+    still detected (if the cap applies, the warm-up frames are not
+    background and the background entropy is that of a flat spectrum).
+    The warm-up frames are then decided like all other frames, i.e. the
+    events of the warm-up are returned (with their original times) once
+    it is complete. After that the noise floor follows the background:
+    it drops fast (a quieter frame is background by definition) and rises
+    slowly, so that it also recovers from a persistent increase of the
+    noise level.
+
+    Events are decided with hysteresis: "start" after min_speech seconds of
+    voiced frames, "end" after min_silence seconds of unvoiced frames.
+    Event times refer to the first voiced / unvoiced frame, so the decision
+    latency is min_speech (resp. min_silence) plus one window (0.07 and
+    0.1 seconds with the default parameters), except for the events of the
+    warm-up, which are returned when the warm-up is complete.
+
+    USAGE EXAMPLE:
+        vad = StreamingVAD(16000)
+        for chunk in chunks:
+            for event, time in vad.push(chunk):
+                print(event, time)      # e.g. "start" 0.52
+        events = vad.flush()            # closes an open speech segment
+    """
+
+    def __init__(self, sampling_rate, window=0.02, step=0.01,
+                 min_speech=0.05, min_silence=0.08, energy_margin=10.0,
+                 entropy_margin=0.2, min_energy=-60.0, warmup=0.5,
+                 initial_floor=-45.0):
+        self.sampling_rate = sampling_rate
+        self.window = int(window * sampling_rate)
+        self.step = int(step * sampling_rate)
+        self.step_time = self.step / float(sampling_rate)
+        self.onset_frames = max(int(round(min_speech / step)), 1)
+        self.offset_frames = max(int(round(min_silence / step)), 1)
+        self.energy_margin = energy_margin
+        self.entropy_margin = entropy_margin
+        self.min_energy = min_energy
+        self.warmup_frames = max(int(round(warmup / step)), 1)
+        self.initial_floor = initial_floor
+        self.reset()
+
+    def reset(self):
+        """Clears all carried state (e.g. at the start of a new recording)"""
+        self.tail = np.zeros((0,))
+        # samples up to the next frame start that have not been received
+        # yet (if the step is longer than the window)
+        self.samples_to_skip = 0
+        self.n_frames = 0
+        self.noise_energy = None
+        self.noise_entropy = None
+        # (energy, entropy) of the frames of the warm-up
+        self.warmup = []
+        self.in_speech = False
+        # number of consecutive frames that contradict the current state
+        self.run = 0
+        self.segments = []
+
+    def frame_statistics(self, frames):
+        """
+        Returns the energy (in dB relative to full scale) and the spectral
+        entropy of each row of a frame matrix
+        """
+        frames = frames - frames.mean(axis=1, keepdims=True)
+        energy = 10 * np.log10(stf.energy_frames(frames) + 1e-12)
+        entropy = stf.block_entropy_frames(stf.fft_magnitude_frames(frames))
+        return energy, entropy
+
+    def initialize_background(self):
+        """
+        Initializes the background estimates from the warm-up frames and
+        decides them
+        RETURNS
+            events:    the events of the warm-up frames
+        """
+        energies, entropies = np.array(self.warmup).T
+        self.warmup = []
+        self.noise_energy = float(np.percentile(energies, 10))
+        if self.noise_energy > self.initial_floor:
+            # (speech from the start of the recording)
+            self.noise_energy = self.initial_floor
+            self.noise_entropy = float(np.log2(10))
+        else:
+            self.noise_entropy = float(np.mean(
+                entropies[energies <= self.noise_energy]))
+        events = []
+        for energy, entropy in zip(energies.tolist(), entropies.tolist()):
+            events += self.decide_frame(energy, entropy)
+        return events
+
+    def update_background(self, energy, entropy, rate):
+        """Moves the background estimates towards an unvoiced frame"""
+        if energy < self.noise_energy:
+            # fast decay: a frame cannot be quieter than the background
+            self.noise_energy += 0.5 * (energy - self.noise_energy)
+        else:
+            self.noise_energy += rate * (energy - self.noise_energy)
+        self.noise_entropy += rate * (entropy - self.noise_entropy)
+
+    def push(self, chunk):
+        """
+        Appends a chunk of samples to the detector.
+        RETURNS
+            events:    list of (event, time) tuples, event is "start" or
+                       "end" and time is in seconds from the first sample
+        """
+        chunk = np.asarray(chunk, dtype=np.float64).reshape(-1) / (2.0 ** 15)
+        n_skipped = min(self.samples_to_skip, chunk.shape[0])
+        self.samples_to_skip -= n_skipped
+        self.tail = np.concatenate((self.tail, chunk[n_skipped:]))
+        frames = stf.frame_matrix(self.tail, self.window, self.step)
+        n_new = frames.shape[0]
+        if n_new == 0:
+            return []
+        energies, entropies = self.frame_statistics(frames)
+        self.samples_to_skip = max(n_new * self.step - self.tail.shape[0], 0)
+        self.tail = self.tail[n_new * self.step:]
+
+        events = []
+        for energy, entropy in zip(energies.tolist(), entropies.tolist()):
+            if self.noise_energy is None:
+                self.warmup.append((energy, entropy))
+                if len(self.warmup) == self.warmup_frames:
+                    events += self.initialize_background()
+            else:
+                events += self.decide_frame(energy, entropy)
+        return events
+
+    def decide_frame(self, energy, entropy):
+        """
+        Decides a frame (voiced or not) and updates the detector state
+        RETURNS
+            events:    list of (event, time) tuples
+        """
+        events = []
+        threshold = max(self.noise_energy + self.energy_margin,
+                        self.min_energy)
+        voiced = energy > threshold and \
+            (entropy < self.noise_entropy - self.entropy_margin or
+             energy > threshold + self.energy_margin)
+
+        if voiced == self.in_speech:
+            self.run = 0
+        else:
+            self.run += 1
+            if not self.in_speech and self.run >= self.onset_frames:
+                self.in_speech = True
+                self.run = 0
+                time = (self.n_frames - self.onset_frames + 1) * \
+                    self.step_time
+                events.append(("start", time))
+                self.segments.append([time, None])
+            elif self.in_speech and self.run >= self.offset_frames:
+                self.in_speech = False
+                self.run = 0
+                time = (self.n_frames - self.offset_frames + 1) * \
+                    self.step_time
+                events.append(("end", time))
+                self.segments[-1][1] = time
+
+        if not voiced:
+            # the background keeps adapting (slowly) during speech,
+            # e.g. when the noise level rises permanently
+            self.update_background(energy, entropy,
+                                   0.002 if self.in_speech else 0.02)
+        self.n_frames += 1
+        return events
+
+    def flush(self):
+        """
+        Closes an open speech segment at the end of the stream.
+        RETURNS
+            events:    the events of an incomplete warm-up and / or
+                       [("end", time)]
+        """
+        events = []
+        if self.warmup:
+            events += self.initialize_background()
+        if not self.in_speech:
+            return events
+        self.in_speech = False
+        self.run = 0
+        time = self.n_frames * self.step_time
+        self.segments[-1][1] = time
+        return events + [("end", time)]
+
+
+def speaker_model_features(mid_feats, classifier_all, mean_all, std_all,
+                           classifier_fm, mean_fm, std_fm):
+    """
+    Appends the speaker (classifier_all) and male / female (classifier_fm)
+    probabilities to each column of a mid-term feature matrix. Each model
+    scores the whole (normalized) matrix with one predict_proba() call.
+    RETURNS:
+        - features:    (n_feats + n_speakers + n_genders) x n_windows
+    """
+    p1 = at.classifier_probabilities(classifier_all, "svm_rbf",
+                                     (mid_feats.T - mean_all) / std_all)
+    p2 = at.classifier_probabilities(classifier_fm, "svm_rbf",
+                                     (mid_feats.T - mean_fm) / std_fm)
+    return np.concatenate((mid_feats, p1.T + 1e-4, p2.T + 1e-4), axis=0)
+
+
+# maximum number of windows per cluster used to estimate the mean distance
+# between two clusters (an evenly spaced subsample of larger clusters is used)
+SILHOUETTE_MAX_SAMPLES = 2000
+
+
+def mean_distance(features_a, features_b):
+    """
+    Mean euclidean distance between the rows of two feature matrices,
+    computed in blocks of rows (so that the full distance matrix is never
+    stored) from the squared norms and one matrix product per block
+    """
+    if len(features_a) == 0 or len(features_b) == 0:
+        return np.nan
+    norms_a = np.sum(features_a ** 2, axis=1)
+    norms_b = np.sum(features_b ** 2, axis=1)
+    block_size = max(1, 2 ** 22 // len(features_b))
+    total = 0.0
+    for i in range(0, len(features_a), block_size):
+        dist = norms_a[i:i + block_size, None] + norms_b[None, :] - \
+            2 * np.dot(features_a[i:i + block_size], features_b.T)
+        total += np.sqrt(np.maximum(dist, 0, out=dist)).sum()
+    return total / (len(features_a) * len(features_b))
+
+
+def clustering_silhouette(features, cls, n_clusters,
+                          max_samples=SILHOUETTE_MAX_SAMPLES):
+    """
+    Average silhouette of a clustering, as used by speaker_diarization() to
+    select the number of speakers. Clusters with less than 2% of the
+    windows get a zero silhouette.
+    ARGUMENTS:
+        - features:       feature matrix (n_windows x n_feats)
+        - cls:            cluster label of each window
+        - n_clusters:     number of clusters
+        - max_samples:    (opt) maximum number of windows per cluster used
+                          for the between-cluster distances (None: all)
+    RETURNS:
+        - silhouette:     the average silhouette of the clusters
+    """
+    clust_per_cent = np.bincount(cls, minlength=n_clusters) / float(len(cls))
+    members = [features[cls == c, :] for c in range(n_clusters)]
+    sampled = [m[training_frames(np.arange(len(m)), max_samples)]
+               for m in members]
+    valid = clust_per_cent >= 0.020
+
+    # mean distance between the windows of each pair of clusters
+    # (only needed if one of them is large enough)
+    cross = np.zeros((n_clusters, n_clusters))
+    for c in range(n_clusters):
+        for c2 in range(c + 1, n_clusters):
+            if valid[c] or valid[c2]:
+                cross[c, c2] = cross[c2, c] = mean_distance(sampled[c],
+                                                            sampled[c2])
+
+    sil_1 = np.zeros((n_clusters,))
+    sil_2 = np.zeros((n_clusters,))
+    for c in np.flatnonzero(valid):
+        # compute average distance between samples
+        # that belong to the cluster (a values)
+        sil_1[c] = np.mean(distance.pdist(members[c].T)) * clust_per_cent[c]
+        # ... and keep the minimum distance from samples of other clusters
+        # (i.e. the distance from the "nearest" cluster)
+        sil_temp = [cross[c, c2] * (clust_per_cent[c] +
+                                    clust_per_cent[c2]) / 2.0
+                    for c2 in range(n_clusters) if c2 != c]
+        if sil_temp:
+            sil_2[c] = min(sil_temp)
+    # for each cluster (speaker) compute silhouette
+    sil = (sil_2 - sil_1) / (np.maximum(sil_2, sil_1) + 1e-5)
+    return np.mean(sil)
+
+
+def speaker_count_clustering(features, seeds, speakers):
+    """
+    Clusters the windows to a number of speakers (starting from the first
+    speakers k-means++ seeds) and returns the cluster labels and the
+    average silhouette of the clustering
+    """
+    k_means = sklearn.cluster.KMeans(n_clusters=speakers,
+                                     init=seeds[0:speakers], n_init=1)
+    k_means.fit(features)
+    cls = k_means.labels_
+    return cls, clustering_silhouette(features, cls, speakers)
+
+
+def speaker_count_sweep(features, s_range, n_jobs=1, early_stopping=None):
+    """
+    Clusters the windows for each candidate number of speakers.
+    ARGUMENTS:
+        - features:          feature matrix (n_windows x n_feats)
+        - s_range:           candidate numbers of speakers (in the order
+                             they are evaluated)
+        - n_jobs:            number of clusterings computed in parallel, on
+                             a pool of threads (see
+                             utilities.effective_n_jobs())
+        - early_stopping:    (opt) stop after this number of candidates
+                             without improvement of the best silhouette
+    RETURNS:
+        - s_range:           the evaluated numbers of speakers
+        - cluster_labels:    the cluster labels of each evaluated number
+        - sil_all:           the average silhouette of each evaluated number
+    NOTE:
+        The candidates are evaluated in rounds of n_jobs and the results
+        (including the early stopping point) are the same for any n_jobs.
+    """
+    s_range = list(s_range)
+    # k-means++ seeds are computed once: the first k of them are the
+    # initial centers of the clustering with k speakers
+    seeds, _ = sklearn.cluster.kmeans_plusplus(features, max(s_range),
+                                               random_state=0)
+    n_workers = min(utilities.effective_n_jobs(n_jobs), len(s_range))
+    cluster_labels = []
+    sil_all = []
+    best, n_worse = -np.inf, 0
+    executor = concurrent.futures.ThreadPoolExecutor(n_workers) \
+        if n_workers > 1 else None
+    try:
+        for i in range(0, len(s_range), n_workers):
+            candidates = s_range[i:i + n_workers]
+            if executor is None:
+                results = [speaker_count_clustering(features, seeds, k)
+                           for k in candidates]
+            else:
+                results = list(executor.map(
+                    lambda k: speaker_count_clustering(features, seeds, k),
+                    candidates))
+            for cls, sil in results:
+                cluster_labels.append(cls)
+                # keep the AVERAGE SILLOUETTE
+                sil_all.append(sil)
+                if sil > best:
+                    best, n_worse = sil, 0
+                else:
+                    n_worse += 1
+                if early_stopping is not None and n_worse >= early_stopping:
+                    return s_range[0:len(sil_all)], cluster_labels, sil_all
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return s_range[0:len(sil_all)], cluster_labels, sil_all
+
+
 def speaker_diarization(filename, n_speakers, mid_window=1.0, mid_step=0.1,
-                        short_window=0.1, lda_dim=0, plot_res=False):
+                        short_window=0.1, lda_dim=0, plot_res=False,
+                        n_jobs=1, early_stopping=None):
     """
     ARGUMENTS:
         - filename:        the name of the WAV file to be analyzed
@@ -824,6 +1728,12 @@ def speaker_diarization(filename, n_speakers, mid_window=1.0, mid_step=0.1,
         - short_window  (opt)    short-term window size
         - lda_dim (opt     LDA dimension (0 for no LDA)
         - plot_res         (opt)   0 for not plotting the results 1 for plotting
+        - n_jobs (opt)     number of speaker counts clustered in parallel
+                           when n_speakers is unknown (see
+                           speaker_count_sweep())
+        - early_stopping (opt)  stop the speaker count sweep after this
+                           number of counts without silhouette improvement
+                           (None: all counts from 2 to 9 are evaluated)
     """
     sampling_rate, signal = audioBasicIO.read_audio_file(filename)
     signal = audioBasicIO.stereo_to_mono(signal)
@@ -832,10 +1742,12 @@ def speaker_diarization(filename, n_speakers, mid_window=1.0, mid_step=0.1,
     base_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)),
                             "data/models")
 
+    # (the speaker models are loaded once per process)
     classifier_all, mean_all, std_all, class_names_all, _, _, _, _, _ = \
-        at.load_model(os.path.join(base_dir, "svm_rbf_speaker_10"))
+        at.load_model_cached(os.path.join(base_dir, "svm_rbf_speaker_10"))
     classifier_fm, mean_fm, std_fm, class_names_fm, _, _, _, _,  _ = \
-        at.load_model(os.path.join(base_dir, "svm_rbf_speaker_male_female"))
+        at.load_model_cached(os.path.join(base_dir,
+                                          "svm_rbf_speaker_male_female"))
 
 
     mid_feats, st_feats, a = \
@@ -845,18 +1757,9 @@ def speaker_diarization(filename, n_speakers, mid_window=1.0, mid_step=0.1,
                                    round(sampling_rate * 0.05),
                                    round(sampling_rate * 0.05))
 
-    mid_term_features = np.zeros((mid_feats.shape[0] + len(class_names_all) +
-                                  len(class_names_fm), mid_feats.shape[1]))
-    for index in range(mid_feats.shape[1]):
-        feature_norm_all = (mid_feats[:, index] - mean_all) / std_all
-        feature_norm_fm = (mid_feats[:, index] - mean_fm) / std_fm
-        _, p1 = at.classifier_wrapper(classifier_all, "svm_rbf", feature_norm_all)
-        _, p2 = at.classifier_wrapper(classifier_fm, "svm_rbf", feature_norm_fm)
-        start = mid_feats.shape[0]
-        end = mid_feats.shape[0] + len(class_names_all)
-        mid_term_features[0:mid_feats.shape[0], index] = mid_feats[:, index]
-        mid_term_features[start:end, index] = p1 + 1e-4
-        mid_term_features[end::, index] = p2 + 1e-4
+    mid_term_features = speaker_model_features(
+        mid_feats, classifier_all, mean_all, std_all,
+        classifier_fm, mean_fm, std_fm)
     # normalize features:
     scaler = StandardScaler()
     mid_feats_norm = scaler.fit_transform(mid_term_features.T)
@@ -883,43 +1786,13 @@ def speaker_diarization(filename, n_speakers, mid_window=1.0, mid_step=0.1,
         # extract mid-term features with minimum step:
         window_ratio = int(round(mid_window / short_window))
         step_ratio = int(round(short_window / short_window))
-        mt_feats_to_red = []
-        num_of_features = len(st_feats)
-        num_of_stats = 2
-        for index in range(num_of_stats * num_of_features):
-            mt_feats_to_red.append([])
-
-        # for each of the short-term features:
-        for index in range(num_of_features):
-            cur_pos = 0
-            feat_len = len(st_feats[index])
-            while cur_pos < feat_len:
-                n1 = cur_pos
-                n2 = cur_pos + window_ratio
-                if n2 > feat_len:
-                    n2 = feat_len
-                short_features = st_feats[index][n1:n2]
-                mt_feats_to_red[index].append(np.mean(short_features))
-                mt_feats_to_red[index + num_of_features].\
-                    append(np.std(short_features))
-                cur_pos += step_ratio
-        mt_feats_to_red = np.array(mt_feats_to_red)
-        mt_feats_to_red_2 = np.zeros((mt_feats_to_red.shape[0] +
-                                      len(class_names_all) +
-                                      len(class_names_fm),
-                                      mt_feats_to_red.shape[1]))
-        limit = mt_feats_to_red.shape[0] + len(class_names_all)
-        for index in range(mt_feats_to_red.shape[1]):
-            feature_norm_all = (mt_feats_to_red[:, index] - mean_all) / std_all
-            feature_norm_fm = (mt_feats_to_red[:, index] - mean_fm) / std_fm
-            _, p1 = at.classifier_wrapper(classifier_all, "svm_rbf",
-                                          feature_norm_all)
-            _, p2 = at.classifier_wrapper(classifier_fm, "svm_rbf", feature_norm_fm)
-            mt_feats_to_red_2[0:mt_feats_to_red.shape[0], index] = \
-                mt_feats_to_red[:, index]
-            mt_feats_to_red_2[mt_feats_to_red.shape[0]:limit, index] = p1 + 1e-4
-            mt_feats_to_red_2[limit::, index] = p2 + 1e-4
-        mt_feats_to_red = mt_feats_to_red_2
+        # (mean and std of each short-term feature over window_ratio frames,
+        # starting at every step_ratio-th frame)
+        mt_feats_to_red, _ = mtf.mid_term_statistics(
+            st_feats, [""] * len(st_feats), window_ratio, step_ratio, 1, 1)
+        mt_feats_to_red = speaker_model_features(
+            mt_feats_to_red, classifier_all, mean_all, std_all,
+            classifier_fm, mean_fm, std_fm)
         scaler = StandardScaler()
         mt_feats_to_red = scaler.fit_transform(mt_feats_to_red.T).T
         labels = np.zeros((mt_feats_to_red.shape[1], ))
@@ -936,57 +1809,13 @@ def speaker_diarization(filename, n_speakers, mid_window=1.0, mid_step=0.1,
         s_range = range(2, 10)
     else:
         s_range = [n_speakers]
-    cluster_labels = []
-    sil_all = []
-    cluster_centers = []
-    
-    for speakers in s_range:
-        k_means = sklearn.cluster.KMeans(n_clusters=speakers)
-        k_means.fit(mid_feats_norm)
-        cls = k_means.labels_ 
-        cluster_labels.append(cls)
-#        cluster_centers.append(means)
-        sil_1 = []; sil_2 = []
-        for c in range(speakers):
-            # for each speaker (i.e. for each extracted cluster)
-            clust_per_cent = np.nonzero(cls == c)[0].shape[0] / float(len(cls))
-            if clust_per_cent < 0.020:
-                sil_1.append(0.0)
-                sil_2.append(0.0)
-            else:
-                # get subset of feature vectors
-                mt_feats_norm_temp = mid_feats_norm[cls == c, :]
-                # compute average distance between samples
-                # that belong to the cluster (a values)
-                dist = distance.pdist(mt_feats_norm_temp.T)
-                sil_1.append(np.mean(dist)*clust_per_cent)
-                sil_temp = []
-                for c2 in range(speakers):
-                    # compute distances from samples of other clusters
-                    if c2 != c:
-                        clust_per_cent_2 = np.nonzero(cls == c2)[0].shape[0] /\
-                                           float(len(cls))
-                        mid_features_temp = mid_feats_norm[cls == c2, :]
-                        dist = distance.cdist(mt_feats_norm_temp,
-                                              mid_features_temp)
-                        sil_temp.append(np.mean(dist)*(clust_per_cent
-                                                       + clust_per_cent_2)/2.0)
-                sil_temp = np.array(sil_temp)
-                # ... and keep the minimum value (i.e.
-                # the distance from the "nearest" cluster)
-                sil_2.append(min(sil_temp))
-        sil_1 = np.array(sil_1)
-        sil_2 = np.array(sil_2)
-        sil = []
-        for c in range(speakers):
-            # for each cluster (speaker) compute silhouette
-            sil.append((sil_2[c] - sil_1[c]) / (max(sil_2[c], sil_1[c]) + 1e-5))
-        # keep the AVERAGE SILLOUETTE
-        sil_all.append(np.mean(sil))
+    s_range, cluster_labels, sil_all = speaker_count_sweep(
+        mid_feats_norm, s_range, n_jobs, early_stopping)
 
     imax = int(np.argmax(sil_all))
     # optimal number of clusters
     num_speakers = s_range[imax]
+    cls = cluster_labels[imax]
 
     # generate the final set of cluster labels
     # (important: need to retrieve the outlier windows:
@@ -1090,8 +1919,63 @@ def speaker_diarization_evaluation(folder_name, lda_dimensions):
                                 plot_res=False)
 
 
+def self_similarity_blocks(feature_vectors, block_size=256,
+                           dtype=np.float32):
+    """
+    Yields the rows of the self-similarity matrix of a sequence of feature
+    vectors (see self_similarity_matrix()) in blocks of block_size rows,
+    so that the whole matrix is never stored
+    """
+    scaler = StandardScaler()
+    norm_feature_vectors = scaler.fit_transform(feature_vectors.T)
+    norm_feature_vectors /= np.linalg.norm(norm_feature_vectors, axis=1,
+                                           keepdims=True) + 1e-15
+    norm_feature_vectors = norm_feature_vectors.astype(dtype)
+    for i in range(0, norm_feature_vectors.shape[0], block_size):
+        yield np.dot(norm_feature_vectors[i:i + block_size],
+                     norm_feature_vectors.T)
+
+
+def diagonal_moving_sum(row_blocks, n_rows, n_cols, length,
+                        dtype=np.float64):
+    """
+    Diagonal moving sum of a matrix: out[i, j] is the sum of matrix[i + k,
+    j + k] for k = 0, ..., length - 1 (i.e. the "valid" 2D convolution
+    with np.eye(length)). It is computed from the cumulative sums along the
+    diagonals, which only need the last length + 1 rows, so the matrix can
+    be given as an iterable of blocks of rows (e.g. self_similarity_blocks)
+    ARGUMENTS:
+     - row_blocks:    iterable of consecutive blocks of rows of the matrix
+     - n_rows:        number of rows of the matrix
+     - n_cols:        number of columns of the matrix
+     - length:        length of the diagonal filter
+     - dtype:         dtype of the output
+    RETURNS:
+     - out:           (n_rows - length + 1) x (n_cols - length + 1) matrix
+    """
+    out = np.zeros((max(n_rows - length + 1, 0), max(n_cols - length + 1, 0)),
+                   dtype=dtype)
+    # cumulative sums of the last length + 1 rows (a ring buffer), row i
+    # is cum[i, j] = matrix[i - 1, j - 1] + cum[i - 1, j - 1]
+    cum = np.zeros((length + 1, n_cols + 1))
+    i = 0
+    for block in row_blocks:
+        for row in block:
+            previous = cum[i % (length + 1)]
+            i += 1
+            current = cum[i % (length + 1)]
+            current[0] = 0
+            np.add(previous[:-1], row, out=current[1:])
+            if i >= length:
+                np.subtract(current[length:],
+                            cum[(i - length) % (length + 1)][:-length],
+                            out=out[i - length], casting="unsafe")
+    return out
+
+
 def music_thumbnailing(signal, sampling_rate, short_window=1.0, short_step=0.5,
-                       thumb_size=10.0, limit_1=0, limit_2=1):
+                       thumb_size=10.0, limit_1=0, limit_2=1,
+                       low_memory=False):
     """
     This function detects instances of the most representative part of a
     music recording, also called "music thumbnails".
@@ -1116,6 +2000,11 @@ def music_thumbnailing(signal, sampling_rate, short_window=1.0, short_step=0.5,
      - short_window:     window size (in seconds)
      - short_step:    window step (in seconds)
      - thumb_size:    desider thumbnail size (in seconds)
+     - low_memory:    (optional) if True, the self-similarity matrix is
+                      computed in float32 blocks of rows that are
+                      filtered on the fly (it is never stored), and the
+                      returned (filtered) matrix is float32. Recommended
+                      for long tracks
     
     RETURNS:
      - A1:            beginning of 1st thumbnail (in seconds)
@@ -1138,20 +2027,23 @@ def music_thumbnailing(signal, sampling_rate, short_window=1.0, short_step=0.5,
                                          sampling_rate * short_window,
                                          sampling_rate * short_step)
 
-    # self-similarity matrix
-    sim_matrix = self_similarity_matrix(st_feats)
-
-    # moving filter:
+    # self-similarity matrix and moving (diagonal) filter:
     m_filter = int(round(thumb_size / short_step))
-    diagonal = np.eye(m_filter, m_filter)
-    sim_matrix = scipy.signal.convolve2d(sim_matrix, diagonal, 'valid')
+    if low_memory:
+        sim_matrix = diagonal_moving_sum(self_similarity_blocks(st_feats),
+                                         st_feats.shape[1], st_feats.shape[1],
+                                         m_filter, np.float32)
+    else:
+        sim_matrix = diagonal_moving_sum([self_similarity_matrix(st_feats)],
+                                         st_feats.shape[1], st_feats.shape[1],
+                                         m_filter)
 
-    # post-processing (remove main diagonal elements)
+    # post-processing (remove main diagonal elements), i.e. all elements
+    # with abs(i-j) < 5.0 / short_step or i > j (j - i < 5.0 / short_step)
     min_sm = np.min(sim_matrix)
-    for i in range(sim_matrix.shape[0]):
-        for j in range(sim_matrix.shape[1]):
-            if abs(i-j) < 5.0 / short_step or i > j:
-                sim_matrix[i, j] = min_sm
+    band = int(np.ceil(5.0 / short_step)) - 1
+    sim_matrix[np.tri(sim_matrix.shape[0], sim_matrix.shape[1], band,
+                      dtype=bool)] = min_sm
 
     # find max position:
     sim_matrix[0:int(limit_1 * sim_matrix.shape[0]), :] = min_sm
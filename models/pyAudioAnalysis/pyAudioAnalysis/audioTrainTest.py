@@ -93,6 +93,26 @@ def classifier_wrapper(classifier, classifier_type, test_sample):
     return class_id, probability
 
 
+def classifier_probabilities(classifier, classifier_type, test_samples):
+    """
+    Batched counterpart of classifier_wrapper(): returns the probability
+    estimates of all rows of a feature matrix, scored with a single
+    predict_proba() call.
+    ARGUMENTS:
+        - classifier:        a classifier object (see classifier_wrapper())
+        - classifier_type:   "svm" or "knn" or "randomforests" or
+                             "gradientboosting" or "extratrees" or "svm_rbf"
+        - test_samples:      a (normalized) feature matrix
+                             [n_samples x numOfDimensions]
+    RETURNS:
+        - P:                 probability estimates [n_samples x n_classes]
+    """
+    if classifier_type == "knn":
+        return np.array([classifier.classify(test_sample)[1]
+                         for test_sample in test_samples])
+    return classifier.predict_proba(test_samples)
+
+
 def regression_wrapper(model, model_type, test_sample):
     """
     This function is used as a wrapper to pattern classification.
@@ -237,7 +257,7 @@ def extract_features_and_train(paths, mid_window, mid_step, short_window,
                                short_step, classifier_type, model_name,
                                compute_beat=False, train_percentage=0.90,
                                dict_of_ids=None,
-                               use_smote=False):
+                               use_smote=False, n_jobs=1):
     """
     This function is used as a wrapper to segment-based audio feature extraction
     and classifier training.
@@ -251,6 +271,7 @@ def extract_features_and_train(paths, mid_window, mid_step, short_window,
                                     "gradientboosting" or "extratrees"
         model_name:                 name of the model to be saved
         dict_of_ids:                a dictionary which has as keys the full path of audio files and as values the respective group ids
+        n_jobs:                     number of feature extraction processes
     RETURNS:
         None. Resulting classifier along with the respective model
         parameters are saved on files.
@@ -260,7 +281,8 @@ def extract_features_and_train(paths, mid_window, mid_step, short_window,
     features, class_names, file_names = \
         aF.multiple_directory_feature_extraction(paths, mid_window, mid_step,
                                                  short_window, short_step,
-                                                 compute_beat=compute_beat)
+                                                 compute_beat=compute_beat,
+                                                 n_jobs=n_jobs)
     file_names = [item for sublist in file_names for item in sublist]
     if dict_of_ids:
         list_of_ids = [dict_of_ids[file] for file in file_names]
@@ -279,6 +301,59 @@ def extract_features_and_train(paths, mid_window, mid_step, short_window,
                   " folder is empty or non-existing!")
             return
 
+    train_from_features(features, class_names, classifier_type, model_name,
+                        mid_window, mid_step, short_window, short_step,
+                        compute_beat, list_of_ids, train_percentage,
+                        use_smote)
+
+
+def train_from_feature_store(store_path, classifier_type, model_name,
+                             train_percentage=0.90, use_smote=False):
+    """
+    Same as extract_features_and_train, but the (already extracted)
+    features are read from a feature store (see
+    MidTermFeatures.feature_store_extraction), which is memory-mapped
+    instead of being loaded in RAM.
+    ARGUMENTS:
+        store_path:                 path of the feature store
+        classifier_type:            "svm" or "knn" or "randomforest" or
+                                    "gradientboosting" or "extratrees"
+        model_name:                 name of the model to be saved
+    RETURNS:
+        None. Resulting classifier along with the respective model
+        parameters are saved on files.
+    """
+    store = aF.FeatureStore(store_path)
+    features, class_names, _, list_of_ids = store.class_features()
+    if len(features) == 0:
+        print("trainSVM_feature ERROR: No data found in the feature store!")
+        return
+    parameters = store.index["parameters"]
+    train_from_features(features, class_names, classifier_type, model_name,
+                        parameters["mid_window"], parameters["mid_step"],
+                        parameters["short_window"], parameters["short_step"],
+                        parameters["compute_beat"], list_of_ids,
+                        train_percentage, use_smote)
+
+
+def train_from_features(features, class_names, classifier_type, model_name,
+                        mid_window, mid_step, short_window, short_step,
+                        compute_beat, list_of_ids=None, train_percentage=0.90,
+                        use_smote=False):
+    """
+    Classifier evaluation, parameter selection and training (STEPS B and C
+    of extract_features_and_train) for a list of per-class feature matrices
+    ARGUMENTS:
+        features:                   list of (n_samples x n_feats) matrices
+                                    (one per class)
+        class_names:                list of class names
+        classifier_type, model_name:    see extract_features_and_train
+        mid_window, mid_step, short_window, short_step, compute_beat:
+                                    feature extraction parameters (saved
+                                    along with the model)
+        list_of_ids:                (opt) group id of each sample
+    """
+
     # STEP B: classifier Evaluation and Parameter Selection:
     if classifier_type == "svm" or classifier_type == "svm_rbf":
         classifier_par = np.array([0.001, 0.01,  0.5, 1.0, 5.0, 10.0, 20.0])
@@ -296,14 +371,13 @@ def extract_features_and_train(paths, mid_window, mid_step, short_window,
     for feat in features:
         if feat.ndim == 1: # this class has only 1 sample
             feat = feat.reshape((1, feat.shape[0]))
-        temp = []
-        for i in range(feat.shape[0]):
-            temp_fv = feat[i, :]
-            if (not np.isnan(temp_fv).any()) and (not np.isinf(temp_fv).any()):
-                temp.append(temp_fv.tolist())
-            else:
+        # (the feature matrix is only copied if NaNs are found)
+        valid = np.isfinite(feat).all(axis=1)
+        if not valid.all():
+            for _ in range(np.count_nonzero(~valid)):
                 print("NaN Found! Feature vector not used for training")
-        temp_features.append(np.array(temp))
+            feat = feat[valid]
+        temp_features.append(feat)
     features = temp_features
 
     best_param = evaluate_classifier(features, class_names, classifier_type,
@@ -369,7 +443,8 @@ def save_parameters(path, *parameters):
 
 def feature_extraction_train_regression(folder_name, mid_window, mid_step,
                                         short_window, short_step, model_type,
-                                        model_name, compute_beat=False):
+                                        model_name, compute_beat=False,
+                                        n_jobs=1):
     """
     This function is used as a wrapper to segment-based audio
     feature extraction and classifier training.
@@ -380,6 +455,7 @@ def feature_extraction_train_regression(folder_name, mid_window, mid_step,
         st_win, st_step:        short-term window and step
         model_type:        "svm" or "knn" or "randomforest"
         model_name:        name of the model to be saved
+        n_jobs:            number of feature extraction processes
     RETURNS:
         None. Resulting regression model along with the respective
         model parameters are saved on files.
@@ -389,7 +465,8 @@ def feature_extraction_train_regression(folder_name, mid_window, mid_step,
         aF.multiple_directory_feature_extraction([folder_name], mid_window,
                                                  mid_step, short_window,
                                                  short_step,
-                                                 compute_beat=compute_beat)
+                                                 compute_beat=compute_beat,
+                                                 n_jobs=n_jobs)
     features = features[0]
     filenames = [ntpath.basename(f) for f in filenames[0]]
     f_final = []
@@ -553,6 +630,23 @@ def load_model(model_name, is_regression=False):
             short_window, short_step, compute_beat
 
 
+# models loaded by load_model_cached() (path -> (modification time, model))
+loaded_models = {}
+
+
+def load_model_cached(model_name, is_regression=False):
+    """
+    Same as load_model(), but each model is read only once per process
+    (it is read again only if its files have been modified since)
+    """
+    path = os.path.abspath(model_name)
+    mtime = (os.path.getmtime(path), os.path.getmtime(path + "MEANS"))
+    key = (path, is_regression)
+    if key not in loaded_models or loaded_models[key][0] != mtime:
+        loaded_models[key] = (mtime, load_model(path, is_regression))
+    return loaded_models[key][1]
+
+
 def group_split(X, y, train_indeces, test_indeces, split_id):
     """
     This function splits the data in train and test set according to train/test indeces based on LeaveOneGroupOut
@@ -899,18 +993,46 @@ def features_to_matrix(features):
         - labels:            a vector of class indices
     """
 
-    labels = np.array([])
-    feature_matrix = np.array([])
-    for i, f in enumerate(features):
-        if i == 0:
-            feature_matrix = f
-            labels = i * np.ones((len(f), 1))
-        else:
-            feature_matrix = np.vstack((feature_matrix, f))
-            labels = np.append(labels, i * np.ones((len(f), 1)))
+    if len(features) == 0:
+        return np.array([]), np.array([])
+    labels = np.repeat(np.arange(len(features), dtype=float),
+                       [len(f) for f in features])
+    # consecutive row blocks of the same matrix (e.g. the class matrices of
+    # a memory-mapped feature store) are returned as a view (no copy)
+    feature_matrix = row_blocks_view(features)
+    if feature_matrix is None:
+        feature_matrix = np.concatenate(features)
     return feature_matrix, labels
 
 
+def row_blocks_view(features):
+    """
+    Returns the concatenation of a list of matrices as a view of their
+    common base matrix, if they are consecutive row blocks of it (otherwise
+    it returns None)
+    """
+    base = features[0].base
+    if not isinstance(base, np.ndarray) or base.ndim != 2 or \
+            not base.flags.c_contiguous:
+        return None
+    base_address = base.__array_interface__["data"][0]
+    start, end = None, None
+    for f in features:
+        if f.base is not base or f.shape[1:] != base.shape[1:] or \
+                f.strides != base.strides:
+            return None
+        offset = f.__array_interface__["data"][0] - base_address
+        if offset % base.strides[0] != 0:
+            return None
+        row = offset // base.strides[0]
+        if start is None:
+            start = row
+        elif row != end:
+            return None
+        end = row + f.shape[0]
+    return base[start:end]
+
+
 def pca_wrapper(features, dimensions):
     features, labels = features_to_matrix(features)
     pca = sklearn.decomposition.PCA(n_components=dimensions)
@@ -55,9 +55,6 @@ def peakdet(v, delta, x = None):
     % This function is released to the public domain; Any use is allowed.
     
     """
-    maxtab = []
-    mintab = []
-       
     if x is None:
         x = numpy.arange(len(v))
     
@@ -71,33 +68,90 @@ def peakdet(v, delta, x = None):
     
     if delta <= 0:
         sys.exit('Input argument delta must be positive')
-    
-    mn, mx = numpy.Inf, -numpy.Inf
-    mnpos, mxpos = numpy.NaN, numpy.NaN
-    
-    lookformax = True
-    
-    for i in numpy.arange(len(v)):
-        this = v[i]
-        if this > mx:
-            mx = this
-            mxpos = x[i]
-        if this < mn:
-            mn = this
-            mnpos = x[i]
-        
-        if lookformax:
-            if this < mx-delta:
-                maxtab.append(mxpos)
-                mn = this
-                mnpos = x[i]
-                lookformax = False
-        else:
-            if this > mn+delta:
-                mintab.append(mnpos)
-                mx = this
-                mxpos = x[i]
-                lookformax = True
- 
+
+    maxtab, mintab = peakdet_rows(v, delta)
+    x = numpy.asarray(x)
+    maxtab = x[maxtab[0]] if len(maxtab[0]) > 0 else []
+    mintab = x[mintab[0]] if len(mintab[0]) > 0 else []
     return numpy.array(maxtab), numpy.array(mintab)
 
+
+def turning_points(v):
+    """
+    Returns the positions of the turning points of a signal: its first and
+    last sample and the ends of its (strictly) monotonic runs (for a
+    plateau, only its first sample is kept).
+    Since peakdet() only records extrema and uses strict comparisons,
+    dropping the rest of the samples does not change its result.
+    """
+    changes = numpy.flatnonzero(numpy.diff(v) != 0) + 1
+    positions = numpy.concatenate(([0], changes))
+    direction = numpy.sign(numpy.diff(v[positions]))
+    interior = numpy.flatnonzero(direction[1:] == direction[:-1]) + 1
+    return numpy.delete(positions, interior)
+
+
+def peakdet_rows(v, delta):
+    """
+    Runs peakdet() on each row of a matrix (delta is a scalar or one
+    positive value per row). This is a faster loop, not a vectorized
+    detector: the hysteresis state machine is sequential, and array
+    formulations (cumulative max/min between threshold crossings) were
+    measured slower on noisy feature tracks, where most samples are
+    turning points. Instead, each row is reduced to its turning points
+    with numpy and the state machine is run on the remaining samples as
+    python scalars, with the thresholds (v - delta, v + delta)
+    precomputed, so the results are identical to those of peakdet().
+    RETURNS:
+        maxtab, mintab:   lists (one element per row) of arrays with the
+                          positions of the maxima / minima
+    """
+    v = numpy.atleast_2d(numpy.asarray(v))
+    delta = numpy.broadcast_to(numpy.asarray(delta).reshape(-1),
+                               (v.shape[0],))
+
+    maxtab, mintab = [], []
+    for r in range(v.shape[0]):
+        row_max, row_min = [], []
+        if v.shape[1] > 0:
+            positions = turning_points(v[r])
+            row = v[r][positions]
+            values = row.tolist()
+            below = (row - delta[r]).tolist()
+            above = (row + delta[r]).tolist()
+            mx, mxpos = values[0], 0
+            mn, mnpos = values[0], 0
+            lookformax = True
+            for i, this in enumerate(values):
+                if this > mx:
+                    mx, mxpos = this, i
+                if this < mn:
+                    mn, mnpos = this, i
+                if lookformax:
+                    if this < below[mxpos]:
+                        row_max.append(mxpos)
+                        mn, mnpos = this, i
+                        lookformax = False
+                else:
+                    if this > above[mnpos]:
+                        row_min.append(mnpos)
+                        mx, mxpos = this, i
+                        lookformax = True
+            row_max = positions[row_max]
+            row_min = positions[row_min]
+        maxtab.append(numpy.array(row_max, dtype=int))
+        mintab.append(numpy.array(row_min, dtype=int))
+    return maxtab, mintab
+
+def effective_n_jobs(n_jobs=1):
+    """
+    Returns the number of worker processes that correspond to an n_jobs
+    argument (as in sklearn, None means a single worker and negative
+    values count back from the number of CPUs, i.e. -1 uses all CPUs)
+    """
+    n_cpus = os.cpu_count() or 1
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(n_cpus + 1 + n_jobs, 1)
+    return max(int(n_jobs), 1)